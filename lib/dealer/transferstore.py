@@ -0,0 +1,255 @@
+import os
+import time
+import logging
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+class TransferStore(object):
+    """
+    Append-only time series of transfer progress samples (request, item, site, copied, total), replacing the
+    per-replica RRD files of track_phedex. Samples are chunked per site and per day (UTC):
+      <path>/<site>/<YYYYMMDD>.idx  one line "<request id> <item name>" per key; the line number is the key index
+      <path>/<site>/<YYYYMMDD>.dat  fixed-size records (time, key index, copied, total), see SAMPLE_DTYPE
+    Keys are appended to the index before the samples that use them, so a reader never sees an unknown key.
+    Sample files are memory-mapped on read. They can also be read outside of Python with the record layout
+    little-endian uint32, uint32, float64, float64 (see web/html/dynamo/dealermon/transferstore.php).
+    """
+
+    SAMPLE_DTYPE = np.dtype([('time', '<u4'), ('key', '<u4'), ('copied', '<f8'), ('total', '<f8')])
+
+    def __init__(self, path):
+        """
+        @param path  Base directory of the store
+        """
+
+        self.path = path
+
+    def append(self, site_name, timestamp, samples):
+        """
+        Append samples for one site. Samples at or before the last sample time of the site are ignored.
+        Calls for different sites can be made concurrently.
+        @param site_name  Site name
+        @param timestamp  Sample time
+        @param samples    List of (request id, item name, copied, total)
+        """
+
+        if len(samples) == 0:
+            return
+
+        directory = '%s/%s' % (self.path, site_name)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+        chunk = '%s/%s' % (directory, self._day(timestamp))
+
+        last_samples = self._map_samples(chunk + '.dat')
+        if last_samples is not None and last_samples[-1]['time'] >= timestamp:
+            LOG.info('Samples for %s at %d already exist.', site_name, timestamp)
+            return
+
+        keys = self._read_keys(chunk + '.idx')
+        key_indices = dict((key, index) for index, key in enumerate(keys))
+
+        new_keys = []
+        records = np.empty(len(samples), dtype = TransferStore.SAMPLE_DTYPE)
+
+        for isample, (request_id, item_name, copied, total) in enumerate(samples):
+            key = (request_id, item_name)
+            try:
+                index = key_indices[key]
+            except KeyError:
+                index = key_indices[key] = len(key_indices)
+                new_keys.append(key)
+
+            records[isample] = (timestamp, index, copied, total)
+
+        if len(new_keys) != 0:
+            with open(chunk + '.idx', 'a') as output:
+                for request_id, item_name in new_keys:
+                    output.write('%d %s\n' % (request_id, item_name))
+
+        with open(chunk + '.dat', 'ab') as output:
+            # drop a partial record left by an interrupted append so that the new records are aligned
+            size = os.fstat(output.fileno()).st_size
+            if size % TransferStore.SAMPLE_DTYPE.itemsize != 0:
+                output.truncate(size - size % TransferStore.SAMPLE_DTYPE.itemsize)
+
+            output.write(records.tostring())
+
+    def site_samples(self, site_name, start, end):
+        """
+        @param site_name  Site name
+        @param start      Start time (inclusive)
+        @param end        End time (inclusive)
+        @return  (keys, samples) where keys is a list of (request id, item name) and samples is an array of SAMPLE_DTYPE
+                 records ordered by time, with the key field indexing keys.
+        """
+
+        keys = []
+        key_indices = {}
+        arrays = []
+
+        for day in self._days(start, end):
+            chunk = '%s/%s/%s' % (self.path, site_name, day)
+
+            samples = self._map_samples(chunk + '.dat')
+            if samples is None:
+                continue
+
+            samples = samples[(samples['time'] >= start) & (samples['time'] <= end)]
+            if len(samples) == 0:
+                continue
+
+            # translate the chunk key indices into indices of the merged key list
+            chunk_keys = self._read_keys(chunk + '.idx')
+            translation = np.empty(len(chunk_keys), dtype = np.uint32)
+            for index, key in enumerate(chunk_keys):
+                try:
+                    translation[index] = key_indices[key]
+                except KeyError:
+                    translation[index] = key_indices[key] = len(keys)
+                    keys.append(key)
+
+            samples = samples.copy()
+            samples['key'] = translation[samples['key']]
+            arrays.append(samples)
+
+        if len(arrays) == 0:
+            return keys, np.empty(0, dtype = TransferStore.SAMPLE_DTYPE)
+        else:
+            return keys, np.concatenate(arrays)
+
+    def item_series(self, site_name, request_id, item_name, start, end):
+        """
+        @return  (times, copied, total) arrays of one (request, item) at a site
+        """
+
+        keys, samples = self.site_samples(site_name, start, end)
+
+        try:
+            index = keys.index((request_id, item_name))
+        except ValueError:
+            samples = samples[:0]
+        else:
+            samples = samples[samples['key'] == index]
+
+        return samples['time'], samples['copied'], samples['total']
+
+    def site_series(self, site_name, start, end):
+        """
+        Per-site aggregate: copied and total summed over all requests and items at each sample time.
+        @return  (times, copied, total) arrays
+        """
+
+        keys, samples = self.site_samples(site_name, start, end)
+        return self._aggregate(samples)
+
+    def request_series(self, request_id, start, end, site_names = None):
+        """
+        Per-request aggregate: copied and total summed over all items and sites at each sample time.
+        @param site_names  Sites to consider (default: all sites in the store)
+        @return  (times, copied, total) arrays
+        """
+
+        if site_names is None:
+            site_names = self.sites()
+
+        arrays = []
+
+        for site_name in site_names:
+            keys, samples = self.site_samples(site_name, start, end)
+            indices = [index for index, key in enumerate(keys) if key[0] == request_id]
+            if len(indices) != 0:
+                arrays.append(samples[np.in1d(samples['key'], indices)])
+
+        if len(arrays) == 0:
+            return self._aggregate(np.empty(0, dtype = TransferStore.SAMPLE_DTYPE))
+        else:
+            return self._aggregate(np.concatenate(arrays))
+
+    def copied_at(self, site_name, timestamp, lookback = 24 * 3600):
+        """
+        @param site_name  Site name
+        @param timestamp  Time
+        @param lookback   How far before timestamp to look for samples
+        @return  {(request id, item name): copied} from the last sample at or before timestamp of each key
+        """
+
+        keys, samples = self.site_samples(site_name, timestamp - lookback, timestamp)
+
+        # samples are ordered by time; take the last occurrence of each key
+        reverse = samples[::-1]
+        indices, positions = np.unique(reverse['key'], return_index = True)
+
+        return dict((keys[index], copied) for index, copied in zip(indices.tolist(), reverse['copied'][positions].tolist()))
+
+    def sites(self):
+        try:
+            return sorted(name for name in os.listdir(self.path) if os.path.isdir('%s/%s' % (self.path, name)))
+        except OSError:
+            return []
+
+    def prune(self, before):
+        """
+        Delete the chunks of days that ended before the given time.
+        @param before  Time
+        """
+
+        last_day = self._day(before)
+
+        for site_name in self.sites():
+            directory = '%s/%s' % (self.path, site_name)
+
+            for file_name in os.listdir(directory):
+                day, ext = os.path.splitext(file_name)
+                if ext not in ('.idx', '.dat') or day >= last_day:
+                    continue
+
+                LOG.debug('Deleting %s/%s', directory, file_name)
+                os.unlink('%s/%s' % (directory, file_name))
+
+    def _aggregate(self, samples):
+        times, inverse = np.unique(samples['time'], return_inverse = True)
+        copied = np.bincount(inverse, weights = samples['copied'], minlength = len(times))
+        total = np.bincount(inverse, weights = samples['total'], minlength = len(times))
+
+        return times, copied, total
+
+    def _map_samples(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+
+        # an interrupted append can leave a partial record at the end
+        num_samples = size // TransferStore.SAMPLE_DTYPE.itemsize
+        if num_samples == 0:
+            return None
+
+        return np.memmap(path, dtype = TransferStore.SAMPLE_DTYPE, mode = 'r', shape = (num_samples,))
+
+    def _read_keys(self, path):
+        keys = []
+        try:
+            with open(path) as source:
+                for line in source:
+                    if not line.endswith('\n'):
+                        # being appended
+                        break
+
+                    request_id, item_name = line.split()
+                    keys.append((int(request_id), item_name))
+        except IOError:
+            pass
+
+        return keys
+
+    def _day(self, timestamp):
+        return time.strftime('%Y%m%d', time.gmtime(timestamp))
+
+    def _days(self, start, end):
+        day_start = int(start) / 86400 * 86400
+        return [self._day(t) for t in xrange(day_start, int(end) + 1, 86400)]
@@ -0,0 +1,117 @@
+import os
+import json
+import logging
+
+from dynamo.dataformat import Block, ObjectError
+
+LOG = logging.getLogger(__name__)
+
+class TransferTracker(object):
+    """
+    Local index of the transfer requests followed by track_phedex. For each request, the index keeps the state of its
+    subscriptions (latest time_update and summed percent_bytes and percent_files), the time it was last polled, and
+    the last seen (total, copied) bytes per (site, dataset). Only the requests whose subscription state changed or
+    that were not polled for a maximum age need to be polled again. The history of the byte counts is kept in
+    dynamo.dealer.transferstore.
+
+    The index is saved as JSON:
+      {request id: {"state": [time_update, percent_bytes, percent_files], "poll_time": t, "items": {site: {dataset: [total, copied]}}}}
+    """
+
+    def __init__(self, path):
+        """
+        @param path  Path of the index file
+        """
+
+        self.path = path
+
+        self._requests = {}
+
+    def load(self):
+        try:
+            with open(self.path) as source:
+                requests = json.load(source)
+        except (IOError, ValueError):
+            LOG.info('Transfer request index not found at %s. Polling all requests.', self.path)
+            requests = {}
+
+        self._requests = dict((int(request_id), entry) for request_id, entry in requests.iteritems())
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as output:
+            json.dump(self._requests, output)
+
+        os.rename(tmp_path, self.path)
+
+    def requests_to_poll(self, states, now, max_age):
+        """
+        Drop the requests that are not listed any more (complete or too old) and return the ones to poll.
+        @param states   {request id: [latest time_update, summed percent_bytes, summed percent_files] of its subscriptions}
+        @param now      Current time
+        @param max_age  Requests polled longer than max_age seconds ago are polled even if their state did not change
+        @return  List of new request ids, of those whose state changed, and of those polled before now - max_age
+        """
+
+        for request_id in self._requests.keys():
+            if request_id not in states:
+                self._requests.pop(request_id)
+
+        to_poll = []
+        for request_id, state in states.iteritems():
+            try:
+                entry = self._requests[request_id]
+                # indices written before the state was introduced have time_update only
+                if entry.get('state') == state and now - entry.get('poll_time', 0) < max_age:
+                    continue
+            except KeyError:
+                pass
+
+            to_poll.append(request_id)
+
+        return to_poll
+
+    def set_status(self, request_id, state, poll_time, status):
+        """
+        Set the byte counts of a request.
+        @param request_id  Request id
+        @param state       [latest time_update, summed percent_bytes, summed percent_files] of the subscriptions of the request
+        @param poll_time   Time of the status query
+        @param status      Return value of transfer_request_status: {(site name, dataset or block name): (total, copied, last update) or None}
+        """
+
+        totals = {} # {site: {dataset: [total, copied]}}
+
+        for (site_name, item_name), status_data in status.iteritems():
+            if status_data is None:
+                total = copied = 0
+            else:
+                total, copied, last_update = status_data
+
+            try:
+                dataset_name, _ = Block.from_full_name(item_name)
+            except ObjectError:
+                dataset_name = item_name
+
+            site_totals = totals.setdefault(site_name, {})
+            try:
+                current = site_totals[dataset_name]
+            except KeyError:
+                site_totals[dataset_name] = [total, copied]
+            else:
+                current[0] += total
+                current[1] += copied
+
+        self._requests[request_id] = {'state': state, 'poll_time': poll_time, 'items': totals}
+
+    def site_items(self, request_id, site_name):
+        """
+        @param request_id  Request id
+        @param site_name   Site name
+        @return  {dataset name: [total, copied]} (empty if unknown)
+        """
+
+        try:
+            return self._requests[request_id]['items'][site_name]
+        except KeyError:
+            return {}
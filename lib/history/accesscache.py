@@ -0,0 +1,200 @@
+import os
+import json
+import logging
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+class DatasetAccessCache(object):
+    """
+    Local aggregate of the dataset_access_summary table: per dataset, the number of rows, the total number of accesses,
+    and the last access date within the retention window. The aggregate covers all rows with dates before a
+    watermark; rows on and after the watermark can still be rewritten by the popularity update and are read
+    from the DB on every load. Rows that fall out of the retention window are subtracted on load, which requires
+    the DB to keep them for retention_margin months beyond the window; a cache older than the margin is rebuilt.
+
+    Files under the cache directory:
+      accesses.npy  structured array (id, num_rows, num_accesses, last_access) sorted by dataset id (memory-mapped on read)
+      names.txt     dataset names, one per line, aligned with accesses.npy
+      state.json    {"watermark": date, "cutoff": date}
+    """
+
+    # Number of months the expired rows must be kept in the DB after they fall out of the 2-year window
+    retention_margin = 1
+
+    dtype = np.dtype([('id', np.int64), ('num_rows', np.int64), ('num_accesses', np.int64), ('last_access', np.int64)])
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, db):
+        """
+        Update the cache with the rows added to and expired from the DB since the last load.
+        @param db  MySQL interface to the history DB
+        @return  (names, num_accesses, last_access) aggregated per dataset, including the rows after the watermark
+        """
+
+        sql = 'SELECT DATE_SUB(CURDATE(), INTERVAL 2 YEAR), DATE_SUB(CURDATE(), INTERVAL %d MONTH)' % (24 + self.retention_margin)
+        cutoff, floor = map(str, db.query(sql)[0])
+
+        try:
+            watermark = str(db.query('SELECT DATE(`dataset_accesses_last_update`) FROM `popularity_last_update`')[0])
+        except IndexError:
+            watermark = str(db.query('SELECT CURDATE()')[0])
+
+        entries, names, state = self._read()
+
+        if state is not None and state['cutoff'] < floor:
+            LOG.info('Dataset access cache in %s is too old. Rebuilding.', self.path)
+            entries, names, state = np.zeros(0, dtype = self.dtype), [], None
+
+        if state is None:
+            LOG.info('Building the dataset access cache in %s.', self.path)
+            # everything is new
+            old_watermark = old_cutoff = cutoff
+        else:
+            old_watermark = state['watermark']
+            old_cutoff = state['cutoff']
+
+        if watermark < old_watermark:
+            watermark = old_watermark
+
+        name_map = dict(zip(entries['id'].tolist(), names))
+
+        ids = [entries['id']]
+        num_rows = [entries['num_rows']]
+        num_accesses = [entries['num_accesses']]
+        last_access = [entries['last_access']]
+
+        # subtract rows that went out of the retention window
+        if cutoff > old_cutoff:
+            sql = 'SELECT `dataset_id`, COUNT(*), SUM(`num_accesses`) FROM `dataset_access_summary`'
+            sql += ' WHERE `date` > %s AND `date` <= %s AND `date` < %s GROUP BY `dataset_id`'
+            expired = db.query(sql, old_cutoff, cutoff, old_watermark)
+            if len(expired) != 0:
+                expired_ids, expired_rows, expired_accesses = zip(*expired)
+                ids.append(np.array(expired_ids, dtype = np.int64))
+                num_rows.append(-np.array(expired_rows, dtype = np.int64))
+                num_accesses.append(-np.array(expired_accesses, dtype = np.int64))
+                # expired rows are older than any remaining row and do not change the last access
+                last_access.append(np.zeros(len(expired), dtype = np.int64))
+
+        # new rows: fold the ones before the new watermark, keep the rest aside
+        sql = 'SELECT a.`dataset_id`, d.`name`, a.`date` < %s, UNIX_TIMESTAMP(a.`date`), a.`num_accesses` FROM `dataset_access_summary` AS a'
+        sql += ' INNER JOIN `datasets` AS d ON d.`id` = a.`dataset_id`'
+        sql += ' WHERE a.`date` >= %s AND a.`date` > %s'
+
+        recent = []
+        folded = []
+        for dataset_id, name, fold, timestamp, count in db.xquery(sql, watermark, old_watermark, cutoff):
+            name_map[dataset_id] = name
+            if fold:
+                folded.append((dataset_id, timestamp, count))
+            else:
+                recent.append((dataset_id, timestamp, count))
+
+        if len(folded) != 0:
+            folded_ids, folded_timestamps, folded_counts = zip(*folded)
+            ids.append(np.array(folded_ids, dtype = np.int64))
+            num_rows.append(np.ones(len(folded), dtype = np.int64))
+            num_accesses.append(np.array(folded_counts, dtype = np.int64))
+            last_access.append(np.array(folded_timestamps, dtype = np.int64))
+
+        entries = self._aggregate(ids, num_rows, num_accesses, last_access)
+
+        # datasets without any row in the window are dropped
+        entries = entries[entries['num_rows'] > 0]
+
+        LOG.info('Dataset access cache: %d datasets, %d rows folded, %d rows after %s.', len(entries), len(folded), len(recent), watermark)
+
+        self._write(entries, [name_map[i] for i in entries['id'].tolist()], {'watermark': watermark, 'cutoff': cutoff})
+
+        # add the recent rows to the returned aggregate (not saved)
+        if len(recent) != 0:
+            recent_ids, recent_timestamps, recent_counts = zip(*recent)
+            entries = self._aggregate(
+                [entries['id'], np.array(recent_ids, dtype = np.int64)],
+                [entries['num_rows'], np.ones(len(recent), dtype = np.int64)],
+                [entries['num_accesses'], np.array(recent_counts, dtype = np.int64)],
+                [entries['last_access'], np.array(recent_timestamps, dtype = np.int64)]
+            )
+
+        names = [name_map[i] for i in entries['id'].tolist()]
+
+        return names, entries['num_accesses'], entries['last_access']
+
+    def invalidate(self, since):
+        """
+        Drop the cache if rows on or after the given date were rewritten and the cache already includes them.
+        @param since  datetime.date
+        """
+
+        try:
+            with open(self.path + '/state.json') as source:
+                state = json.load(source)
+        except (IOError, ValueError):
+            return
+
+        if since.strftime('%Y-%m-%d') < state['watermark']:
+            LOG.info('Dataset accesses since %s were rewritten. Dropping the access cache.', since.strftime('%Y-%m-%d'))
+            os.unlink(self.path + '/state.json')
+
+    def _aggregate(self, ids, num_rows, num_accesses, last_access):
+        ids = np.concatenate(ids)
+        unique_ids, inverse = np.unique(ids, return_inverse = True)
+
+        entries = np.zeros(len(unique_ids), dtype = self.dtype)
+        entries['id'] = unique_ids
+        entries['num_rows'] = np.bincount(inverse, weights = np.concatenate(num_rows), minlength = len(unique_ids))
+        entries['num_accesses'] = np.bincount(inverse, weights = np.concatenate(num_accesses), minlength = len(unique_ids))
+
+        # maximum per id: sort by (id, last access) and take the last element of each id group
+        last_access = np.concatenate(last_access)
+        order = np.lexsort((last_access, inverse))
+        group_end = np.flatnonzero(np.diff(np.append(inverse[order], -1)) != 0)
+        entries['last_access'][inverse[order][group_end]] = last_access[order][group_end]
+
+        return entries
+
+    def _read(self):
+        try:
+            with open(self.path + '/state.json') as source:
+                state = json.load(source)
+
+            entries = np.load(self.path + '/accesses.npy', mmap_mode = 'r')
+
+            with open(self.path + '/names.txt') as source:
+                names = source.read().splitlines()
+
+        except (IOError, ValueError):
+            return np.zeros(0, dtype = self.dtype), [], None
+
+        if len(names) != len(entries):
+            LOG.warning('Dataset access cache in %s is inconsistent. Rebuilding.', self.path)
+            return np.zeros(0, dtype = self.dtype), [], None
+
+        return entries, names, state
+
+    def _write(self, entries, names, state):
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+        # write to temporary files and move in place; state.json is moved last and validates the other two
+        try:
+            os.unlink(self.path + '/state.json')
+        except OSError:
+            pass
+
+        np.save(self.path + '/accesses.tmp.npy', entries)
+        os.rename(self.path + '/accesses.tmp.npy', self.path + '/accesses.npy')
+
+        with open(self.path + '/names.tmp', 'w') as output:
+            for name in names:
+                output.write(name + '\n')
+        os.rename(self.path + '/names.tmp', self.path + '/names.txt')
+
+        with open(self.path + '/state.tmp', 'w') as output:
+            json.dump(state, output)
+        os.rename(self.path + '/state.tmp', self.path + '/state.json')
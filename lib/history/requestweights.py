@@ -0,0 +1,183 @@
+import os
+import json
+import math
+import time
+import logging
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+class DatasetRequestWeightCache(object):
+    """
+    Local cache of the dataset request weights w = Sum(exp(-t_i/T)). The weights are stored with a reference time
+    and cover all requests queued before a watermark. On load, the weights are decayed to the current time by
+    exp(-dt/T) and the requests queued since the watermark are added, so that only the recent part of the
+    dataset_requests table is read. Requests queued within a day before the last popularity update may still be
+    inserted and are not folded in yet.
+
+    Instead of removing the requests that fall out of the 1-year window, datasets are dropped from the cache once
+    their weight falls below that of a single 1-year-old request.
+
+    Files under the cache directory:
+      weights.npy  weights at the reference time
+      names.txt    dataset names, one per line, aligned with weights.npy
+      state.json   {"reference_time": timestamp, "watermark": timestamp, "decay_constant": T}
+    """
+
+    # Requests queued less than this many seconds before the last update are not folded into the cache
+    watermark_margin = 3600. * 24.
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, db, decay_constant):
+        """
+        @param db              MySQL interface to the history DB
+        @param decay_constant  T in seconds
+        @return  (names, weights) with weights at the current time, including the requests after the watermark
+        """
+
+        now = time.time()
+
+        try:
+            last_update = db.query('SELECT UNIX_TIMESTAMP(`dataset_requests_last_update`) FROM `popularity_last_update`')[0]
+        except IndexError:
+            last_update = now
+
+        names, weights, state = self._read()
+
+        if state is not None and state['decay_constant'] != decay_constant:
+            LOG.info('Request weight decay constant changed. Rebuilding the request weight cache.')
+            state = None
+
+        if state is None:
+            LOG.info('Building the request weight cache in %s.', self.path)
+            names = []
+            weights = np.zeros(0, dtype = np.float64)
+            old_watermark = 0
+        else:
+            old_watermark = state['watermark']
+            # decay the cached weights to now
+            weights = weights * math.exp((state['reference_time'] - now) / decay_constant)
+
+        watermark = max(old_watermark, last_update - self.watermark_margin)
+
+        sql = 'SELECT d.`name`, UNIX_TIMESTAMP(r.`queue_time`) FROM `dataset_requests` AS r'
+        sql += ' INNER JOIN `datasets` AS d ON d.`id` = r.`dataset_id`'
+        sql += ' WHERE r.`queue_time` >= FROM_UNIXTIME(%s) AND r.`queue_time` > DATE_SUB(NOW(), INTERVAL 1 YEAR)'
+
+        folded = []
+        recent = []
+        for name, queue_time in db.xquery(sql, old_watermark):
+            if queue_time < watermark:
+                folded.append((name, queue_time))
+            else:
+                recent.append((name, queue_time))
+
+        names, weights = self._add(names, weights, folded, now, decay_constant)
+
+        # single request queued one year ago
+        threshold = math.exp(-365. * 24. * 3600. / decay_constant)
+        keep = np.flatnonzero(weights >= threshold)
+        names = [names[i] for i in keep.tolist()]
+        weights = weights[keep]
+
+        LOG.info('Request weight cache: %d datasets, %d requests folded, %d requests after the watermark.', len(names), len(folded), len(recent))
+
+        self._write(names, weights, {'reference_time': now, 'watermark': watermark, 'decay_constant': decay_constant})
+
+        return self._add(names, weights, recent, now, decay_constant)
+
+    def invalidate(self, since):
+        """
+        Drop the cache if requests queued before the watermark were inserted.
+        @param since  Earliest queue time (UNIX timestamp) of the inserted requests
+        """
+
+        try:
+            with open(self.path + '/state.json') as source:
+                state = json.load(source)
+        except (IOError, ValueError):
+            return
+
+        if since < state['watermark']:
+            LOG.info('Requests queued at %s were inserted. Dropping the request weight cache.', time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(since)))
+            os.unlink(self.path + '/state.json')
+
+    def _add(self, names, weights, requests, now, decay_constant):
+        """
+        Add exp(-t_i/T) of the requests to the weights.
+        @param names     List of dataset names
+        @param weights   Weights aligned with names
+        @param requests  [(dataset name, queue time)]
+        @return  (names, weights) with the new datasets appended
+        """
+
+        if len(requests) == 0:
+            return names, weights
+
+        positions = dict((name, i) for i, name in enumerate(names))
+        names = list(names)
+
+        index = []
+        queue_times = []
+        for name, queue_time in requests:
+            try:
+                index.append(positions[name])
+            except KeyError:
+                index.append(len(names))
+                positions[name] = len(names)
+                names.append(name)
+
+            queue_times.append(queue_time)
+
+        contributions = np.exp((np.array(queue_times, dtype = np.float64) - now) / decay_constant)
+
+        new_weights = np.zeros(len(names), dtype = np.float64)
+        new_weights[:len(weights)] = weights
+        new_weights += np.bincount(np.array(index, dtype = np.int64), weights = contributions, minlength = len(names))
+
+        return names, new_weights
+
+    def _read(self):
+        try:
+            with open(self.path + '/state.json') as source:
+                state = json.load(source)
+
+            weights = np.load(self.path + '/weights.npy')
+
+            with open(self.path + '/names.txt') as source:
+                names = source.read().splitlines()
+
+        except (IOError, ValueError):
+            return [], None, None
+
+        if len(names) != len(weights):
+            LOG.warning('Request weight cache in %s is inconsistent. Rebuilding.', self.path)
+            return [], None, None
+
+        return names, weights, state
+
+    def _write(self, names, weights, state):
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+        # state.json is moved last and validates the other two
+        try:
+            os.unlink(self.path + '/state.json')
+        except OSError:
+            pass
+
+        np.save(self.path + '/weights.tmp.npy', weights)
+        os.rename(self.path + '/weights.tmp.npy', self.path + '/weights.npy')
+
+        with open(self.path + '/names.tmp', 'w') as output:
+            for name in names:
+                output.write(name + '\n')
+        os.rename(self.path + '/names.tmp', self.path + '/names.txt')
+
+        with open(self.path + '/state.tmp', 'w') as output:
+            json.dump(state, output)
+        os.rename(self.path + '/state.tmp', self.path + '/state.json')
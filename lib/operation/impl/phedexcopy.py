@@ -4,9 +4,10 @@ import collections
 
 from dynamo.operation.copy import CopyInterface
 from dynamo.utils.interface.webservice import POST
-from dynamo.utils.interface.phedex import PhEDEx
+from dynamo.utils.interface.phedex import PhEDEx, pack_items, make_catalog
+from dynamo.utils.parallel import Map
 from dynamo.history.history import HistoryDatabase
-from dynamo.dataformat import DatasetReplica, BlockReplica, Configuration
+from dynamo.dataformat import DatasetReplica, BlockReplica, Configuration, OperationalError
 
 LOG = logging.getLogger(__name__)
 
@@ -18,136 +19,157 @@ class PhEDExCopyInterface(CopyInterface):
 
         CopyInterface.__init__(self, config)
 
-        self._phedex = PhEDEx(config.get('phedex', None))
+        self._phedex_config = config.get('phedex', None)
+        self._phedex = PhEDEx(self._phedex_config)
 
         self._history = HistoryDatabase(config.get('history', None))
 
+        # requests are bin-packed into chunks of at most chunk_size TB and chunk_items datasets or blocks
         self.subscription_chunk_size = config.get('chunk_size', 50.) * 1.e+12
+        self.subscription_chunk_items = config.get('chunk_items', 1000)
+        self._parallel_config = config.get('parallel', Configuration())
+
+        # number of dataset or block names per subscriptions / blockreplicas call in transfer status queries
+        self.status_chunk_size = config.get('status_chunk_size', 500)
 
     def schedule_copies(self, replica_list, operation_id, comments = ''): #override
         sites = set(r.site for r in replica_list)
         if len(sites) != 1:
             raise OperationalError('schedule_copies should be called with a list of replicas at a single site.')
 
-        site = list(sites)[0]
+        LOG.info('Scheduling copy of %d replicas to %s using PhEDEx (operation %d)', len(replica_list), list(sites)[0], operation_id)
 
-        LOG.info('Scheduling copy of %d replicas to %s using PhEDEx (operation %d)', len(replica_list), site, operation_id)
+        return self.schedule_copies_bulk({operation_id: replica_list}, comments)[operation_id]
 
-        # sort the subscriptions into dataset level / block level and by groups
-        subscription_lists = {}
-        subscription_lists['dataset'] = collections.defaultdict(list) # {(level, group_name): [replicas]}
-        subscription_lists['block'] = collections.defaultdict(list) # {(level, group_name): [replicas]}
+    def schedule_copies_bulk(self, replica_lists, comments = ''):
+        """
+        Schedule copies for many operations and sites at once. Subscription chunks of all sites are submitted
+        concurrently by at most parallel.num_threads workers, and the request ids are recorded in one insert. A chunk that
+        fails does not raise, so the requests made by the other chunks are always recorded.
+        @param replica_lists  {operation id: [replicas]}
+        @param comments       Comments for all requests
+        @return  {operation id: [scheduled replicas]}
+        """
 
-        for replica in replica_list:
-            if replica.growing:
-                subscription_lists['dataset'][replica.group].append(replica.dataset)
-            else:
-                blocks_by_group = collections.defaultdict(set)
-                for block_replica in replica.block_replicas:
-                    blocks_by_group[block_replica.group].add(block_replica.block)
+        arg_pool = [] # [((operation id, site, group, level), options, items)]
+
+        for operation_id, replica_list in replica_lists.iteritems():
+            # sort the subscriptions by site, level and group
+            subscription_lists = collections.defaultdict(list) # {(site, level, group): [datasets or blocks]}
 
-                for group, blocks in blocks_by_group.iteritems():
-                    subscription_lists['block'][group].extend(blocks)
+            for replica in replica_list:
+                if replica.growing:
+                    subscription_lists[(replica.site, 'dataset', replica.group)].append(replica.dataset)
+                else:
+                    blocks_by_group = collections.defaultdict(set)
+                    for block_replica in replica.block_replicas:
+                        blocks_by_group[block_replica.group].add(block_replica.block)
+
+                    for group, blocks in blocks_by_group.iteritems():
+                        subscription_lists[(replica.site, 'block', group)].extend(blocks)
+
+            for (site, level, group), items in subscription_lists.iteritems():
+                chunks = pack_items(items, self.subscription_chunk_size, self.subscription_chunk_items)
+
+                LOG.info('Subscribing %d %ss to %s in %d chunks (operation %d).', len(items), level, site.name, len(chunks), operation_id)
+
+                options = {
+                    'node': site.name,
+                    'level': level,
+                    'priority': 'low',
+                    'move': 'n',
+                    'static': 'n',
+                    'custodial': 'n',
+                    'group': group.name,
+                    'request_only': 'n',
+                    'no_mail': 'n',
+                    'comments': comments
+                }
+
+                for chunk in chunks:
+                    arg_pool.append(((operation_id, site, group, level), options, chunk))
 
-        # for convenience, mapping dataset -> replica
-        result = {}
+        # for convenience, mapping (dataset, site) -> replica
+        result = dict((operation_id, {}) for operation_id in replica_lists.iterkeys())
 
-        for level in ['dataset', 'block']:
-            for group, items in subscription_lists[level].iteritems():
-                success = self._run_subscription_request(operation_id, site, group, level, items, comments)
+        history_entries = []
 
-                for replica in success:
-                    if replica.dataset in result:
-                        booked = result[replica.dataset]
+        # the history DB is written from this thread only
+        for (operation_id, site, group, level), requests in Map(self._parallel_config).execute(self._run_subscription_request, arg_pool):
+            booked_replicas = result[operation_id]
+
+            for request_id, items in requests:
+                LOG.warning('PhEDEx subscription request id: %d', request_id)
+                history_entries.append((request_id, 'copy', operation_id, True))
+
+                for dataset, blocks in make_catalog(items).iteritems():
+                    if level == 'dataset':
+                        replica = DatasetReplica(dataset, site, growing = True, group = group)
+                        blocks = dataset.blocks
+                    else:
+                        replica = DatasetReplica(dataset, site, growing = False)
+
+                    for block in blocks:
+                        replica.block_replicas.add(BlockReplica(block, site, group, size = 0, last_update = int(time.time())))
+
+                    try:
+                        booked = booked_replicas[(dataset, site)]
+                    except KeyError:
+                        booked_replicas[(dataset, site)] = replica
+                    else:
                         # need to merge
                         for block_replica in replica.block_replicas:
                             # there shouldn't be any block replica overlap but we will be careful
                             if booked.find_block_replica(block_replica.block) is None:
                                 booked.block_replicas.add(block_replica)
-                    else:
-                        result[replica.dataset] = replica
-
-        return result.values()
-
-    def _run_subscription_request(self, operation_id, site, group, level, subscription_list, comments):
-        # Make a subscription request for potentitally multiple datasets or blocks but to one site and one group
-        full_catalog = collections.defaultdict(list)
-
-        if level == 'dataset':
-            for dataset in subscription_list:
-                full_catalog[dataset] = []
-        elif level == 'block':
-            for block in subscription_list:
-                full_catalog[block.dataset].append(block)
-
-        history_sql = 'INSERT INTO `phedex_requests` (`id`, `operation_type`, `operation_id`, `approved`) VALUES (%s, \'copy\', %s, %s)'
-
-        success = []
-
-        # make requests in chunks
-        request_catalog = {}
-        chunk_size = 0
-        items = []
-        while len(full_catalog) != 0:
-            dataset, blocks = full_catalog.popitem()
-            request_catalog[dataset] = blocks
-
-            if level == 'dataset':
-                chunk_size += dataset.size
-                items.append(dataset)
-            elif level == 'block':
-                chunk_size += sum(b.size for b in blocks)
-                items.extend(blocks)
-            
-            if chunk_size < self.subscription_chunk_size and len(full_catalog) != 0:
-                continue
-
-            options = {
-                'node': site.name,
-                'data': self._phedex.form_catalog_xml(request_catalog),
-                'level': level,
-                'priority': 'low',
-                'move': 'n',
-                'static': 'n',
-                'custodial': 'n',
-                'group': group.name,
-                'request_only': 'n',
-                'no_mail': 'n',
-                'comments': comments
-            }
-
-            try:
-                if self._read_only:
-                    result = [{'id': 0}]
-                else:
-                    result = self._phedex.make_request('subscribe', options, method = POST)
-            except:
-                LOG.error('Copy %s failed.', str(options))
-                # we should probably do something here
-            else:
-                request_id = int(result[0]['id']) # return value is a string
-                LOG.warning('PhEDEx subscription request id: %d', request_id)
-                if not self._read_only:
-                    self._history.db.query(history_sql, request_id, operation_id, True)
 
-                for dataset, blocks in request_catalog.iteritems():
-                    if level == 'dataset':
-                        replica = DatasetReplica(dataset, site, growing = True, group = group)
-                        for block in dataset.blocks:
-                            replica.block_replicas.add(BlockReplica(block, site, group, size = 0, last_update = int(time.time())))
+        if not self._read_only and len(history_entries) != 0:
+            fields = ('id', 'operation_type', 'operation_id', 'approved')
+            self._history.db.insert_many('phedex_requests', fields, None, history_entries, do_update = False)
 
-                    else:
-                        replica = DatasetReplica(dataset, site, growing = False)
-                        for block in blocks:
-                            replica.block_replicas.add(BlockReplica(block, site, group, size = 0, last_update = int(time.time())))
+        return dict((operation_id, booked_replicas.values()) for operation_id, booked_replicas in result.iteritems())
+
+    def _run_subscription_request(self, key, options, items):
+        return key, self._subscribe(options, items)
+
+    def _subscribe(self, options, items):
+        """
+        Make a subscription request for one chunk. If PhEDEx rejects the data (error 400), the chunk is bisected
+        until the offending item is isolated; the other items are subscribed.
+        @param options  Request options except for data
+        @param items    List of datasets or blocks
+        @return  [(request id, items)]
+        """
+
+        # a PhEDEx instance per call so that last_errorcode is not shared between threads
+        phedex = PhEDEx(self._phedex_config)
+
+        writer = phedex.catalog_writer()
+        for item in items:
+            writer.add(item)
 
-                    success.append(replica)
+        request_options = dict(options)
+        request_options['data'] = writer.getvalue()
 
-            request_catalog = {}
-            chunk_size = 0
-            items = []
+        try:
+            if self._read_only:
+                result = [{'id': 0}]
+            else:
+                result = phedex.make_request('subscribe', request_options, method = POST)
+        except:
+            LOG.error('Copy %s failed.', str(request_options))
+
+            if phedex.last_errorcode == 400:
+                if len(items) == 1:
+                    LOG.error('Could not subscribe %s to %s', str(items[0]), options['node'])
+                else:
+                    LOG.info('Retrying with a reduced item list.')
+                    return self._subscribe(options, items[:len(items) / 2]) + self._subscribe(options, items[len(items) / 2:])
 
-        return success
+            # we should probably do something here
+            return []
+
+        return [(int(result[0]['id']), items)] # return value is a string
 
     def copy_status(self, history_record, inventory): #override
         request_ids = self._history.db.query('SELECT `id` FROM `phedex_requests` WHERE `operation_type` = \'copy\' AND `operation_id` = %s', history_record.operation_id)
@@ -158,99 +180,109 @@ class PhEDExCopyInterface(CopyInterface):
         return self.transfer_request_status(request_ids)
 
     def transfer_request_status(self, request_ids):
-        status = {}
+        """
+        @param request_ids  List of request ids
+        @return  {(site name, dataset or block name): (total bytes, copied bytes, last update) or None}
+        """
 
-        LOG.debug('Querying PhEDEx transferrequests for requests %s', request_ids)
-        requests = self._phedex.make_request('transferrequests', [('request', i) for i in request_ids], method = POST)
-        if len(requests) == 0:
-            return status
-
-        for request in requests:
-            # A single request can have multiple destinations
-            site_names = [d['name'] for d in request['destinations']['node']]
-    
-            dataset_names = []
-            for ds_entry in request['data']['dbs']['dataset']:
-                dataset_names.append(ds_entry['name'])
-    
-            block_names = []
-            for ds_entry in request['data']['dbs']['block']:
-                block_names.append(ds_entry['name'])
-
-        if len(dataset_names) != 0:
-            # Process dataset-level subscriptions
-
-            subscriptions = []
-            chunks = [dataset_names[i:i + 35] for i in xrange(0, len(dataset_names), 35)]
-            for site_name in site_names:
-                for chunk in chunks:
-                    subscriptions.extend(self._phedex.make_request('subscriptions', ['node=%s' % site_name] + ['dataset=%s' % n for n in chunk]))
+        status = {}
+        for request_status in self.transfer_request_status_bulk(request_ids).itervalues():
+            status.update(request_status)
 
-            for dataset in subscriptions:
-                dataset_name = dataset['name']
-                try:
-                    cont = dataset['subscription'][0]
-                except KeyError:
-                    LOG.error('Subscription of %s should exist but doesn\'t', dataset_name)
-                    continue
+        return status
 
-                site_name = cont['node']
-                bytes = dataset['bytes']
+    def transfer_request_status_bulk(self, request_ids):
+        """
+        Get the status of many transfer requests at once. All requests are fetched with one transferrequests POST,
+        and each (site, dataset or block) is looked up in subscriptions (and blockreplicas where needed) once,
+        however many requests contain it. The lookups are made concurrently.
+        @param request_ids  List of request ids
+        @return  {request id: {(site name, dataset or block name): (total bytes, copied bytes, last update) or None}}
+        """
 
-                node_bytes = cont['node_bytes']
-                if node_bytes is None:
-                    node_bytes = 0
-                elif node_bytes != bytes:
-                    # it's possible that there were block-level deletions
-                    blocks = self._phedex.make_request('blockreplicas', ['node=%s' % site_name, 'dataset=%s' % dataset_name])
-                    bytes = sum(b['bytes'] for b in blocks)
+        result = dict((request_id, {}) for request_id in request_ids)
 
-                status[(site_name, dataset_name)] = (bytes, node_bytes, cont['time_update'])
+        if len(request_ids) == 0:
+            return result
 
-        if len(block_names) != 0:
-            # Process block-level subscriptions
+        LOG.debug('Querying PhEDEx transferrequests for %d requests', len(request_ids))
+        requests = self._phedex.make_request('transferrequests', [('request', i) for i in request_ids], method = POST)
+        if len(requests) == 0:
+            return result
 
-            subscriptions = []
-            chunks = [block_names[i:i + 35] for i in xrange(0, len(block_names), 35)]
-            for site_name in site_names:
-                for chunk in chunks:
-                    subscriptions.extend(self._phedex.make_request('subscriptions', ['node=%s' % site_name] + ['block=%s' % n for n in chunk]))
+        request_items = {} # {request id: [(site name, item name)]}
+        dataset_names = collections.defaultdict(set) # {site name: set(dataset names)}
+        block_names = collections.defaultdict(set) # {site name: set(block names)}
 
-            overridden = set()
+        for request in requests:
+            items = request_items[int(request['id'])] = []
 
+            # A single request can have multiple destinations
+            for dest in request['destinations']['node']:
+                site_name = dest['name']
+
+                for ds_entry in request['data']['dbs']['dataset']:
+                    dataset_names[site_name].add(ds_entry['name'])
+                    items.append((site_name, ds_entry['name']))
+
+                for ds_entry in request['data']['dbs']['block']:
+                    block_names[site_name].add(ds_entry['name'])
+                    items.append((site_name, ds_entry['name']))
+
+        status = {} # {(site name, item name): (total bytes, copied bytes, last update)}
+
+        # (site, dataset) whose total is to be summed from the block replicas
+        partial_datasets = set()
+        # (site, dataset) whose block-level subscriptions are overridden by a dataset-level subscription
+        overridden = set()
+        # datasets to look up in blockreplicas
+        replica_lookups = collections.defaultdict(set) # {site name: set(dataset names)}
+
+        arg_pool = []
+        for level, names_map in [('dataset', dataset_names), ('block', block_names)]:
+            for site_name, names in names_map.iteritems():
+                names = sorted(names)
+                for i in xrange(0, len(names), self.status_chunk_size):
+                    arg_pool.append((site_name, level, names[i:i + self.status_chunk_size]))
+
+        for site_name, level, subscriptions in Map(self._parallel_config).execute(self._get_subscriptions, arg_pool):
             for dataset in subscriptions:
                 dataset_name = dataset['name']
 
-                try:
-                    blocks = dataset['block']
-                except KeyError:
+                if level == 'dataset':
+                    # Process dataset-level subscriptions
                     try:
                         cont = dataset['subscription'][0]
                     except KeyError:
-                        LOG.error('Subscription of %s neither block-level nor dataset-level', dataset_name)
+                        LOG.error('Subscription of %s should exist but doesn\'t', dataset_name)
                         continue
 
-                    site_name = cont['node']
+                    bytes = dataset['bytes']
 
-                    if (site_name, dataset_name) in overridden:
-                        # this is a dataset-level subscription and we've processed this dataset already
-                        continue
+                    node_bytes = cont['node_bytes']
+                    if node_bytes is None:
+                        node_bytes = 0
+                    elif node_bytes != bytes:
+                        # it's possible that there were block-level deletions
+                        partial_datasets.add((site_name, dataset_name))
+                        replica_lookups[site_name].add(dataset_name)
 
-                    overridden.add((site_name, dataset_name))
+                    status[(site_name, dataset_name)] = (bytes, node_bytes, cont['time_update'])
 
-                    LOG.debug('Block-level subscription of %s at %s is overridden', dataset_name, site_name)
+                    continue
 
-                    requested_blocks = [name for name in block_names if name.startswith(dataset_name + '#')]
+                # Process block-level subscriptions
+                try:
+                    blocks = dataset['block']
+                except KeyError:
+                    if 'subscription' not in dataset:
+                        LOG.error('Subscription of %s neither block-level nor dataset-level', dataset_name)
+                        continue
 
-                    blocks = self._phedex.make_request('blockreplicas', ['node=%s' % site_name, 'dataset=%s' % dataset_name])
-                    for block in blocks:
-                        block_name = block['name']
-                        if block_name not in requested_blocks:
-                            continue
-                        
-                        replica = block['replica'][0]
-                        status[(site_name, block_name)] = (block['bytes'], replica['bytes'], replica['time_update'])
+                    LOG.debug('Block-level subscription of %s at %s is overridden', dataset_name, site_name)
 
+                    overridden.add((site_name, dataset_name))
+                    replica_lookups[site_name].add(dataset_name)
                     continue
 
                 for block in blocks:
@@ -267,16 +299,39 @@ class PhEDExCopyInterface(CopyInterface):
 
                     status[(cont['node'], block_name)] = (block['bytes'], node_bytes, cont['time_update'])
 
-        # now we pick up whatever did not appear in the subscriptions call
-        for site_name in site_names:
-            for dataset_name in dataset_names:
-                key = (site_name, dataset_name)
-                if key not in status:
-                    status[key] = None
+        arg_pool = []
+        for site_name, names in replica_lookups.iteritems():
+            names = sorted(names)
+            for i in xrange(0, len(names), self.status_chunk_size):
+                arg_pool.append((site_name, names[i:i + self.status_chunk_size]))
 
-            for block_name in block_names:
-                key = (site_name, block_name)
-                if key not in status:
-                    status[key] = None
+        replica_bytes = collections.defaultdict(int) # {(site name, dataset name): total bytes of the blocks at the site}
 
-        return status
+        for site_name, blocks in Map(self._parallel_config).execute(self._get_block_replicas, arg_pool):
+            for block in blocks:
+                block_name = block['name']
+                dataset_name = block_name[:block_name.find('#')]
+
+                replica_bytes[(site_name, dataset_name)] += block['bytes']
+
+                if (site_name, dataset_name) in overridden and block_name in block_names[site_name]:
+                    replica = block['replica'][0]
+                    status[(site_name, block_name)] = (block['bytes'], replica['bytes'], replica['time_update'])
+
+        for key in partial_datasets:
+            bytes, node_bytes, last_update = status[key]
+            status[key] = (replica_bytes[key], node_bytes, last_update)
+
+        # whatever did not appear in the subscriptions call is set to None
+        for request_id, items in request_items.iteritems():
+            result[request_id] = dict((key, status.get(key, None)) for key in items)
+
+        return result
+
+    def _get_subscriptions(self, site_name, level, names):
+        options = [('node', site_name)] + [(level, name) for name in names]
+        return site_name, level, self._phedex.make_request('subscriptions', options, method = POST)
+
+    def _get_block_replicas(self, site_name, dataset_names):
+        options = [('node', site_name)] + [('dataset', name) for name in dataset_names]
+        return site_name, self._phedex.make_request('blockreplicas', options, method = POST)
@@ -1,12 +1,15 @@
+import os
+import json
 import time
 import logging
 import collections
 
 from dynamo.operation.deletion import DeletionInterface
 from dynamo.utils.interface.webservice import POST
-from dynamo.utils.interface.phedex import PhEDEx
+from dynamo.utils.interface.phedex import PhEDEx, pack_items
+from dynamo.utils.parallel import Map
 from dynamo.history.history import HistoryDatabase
-from dynamo.dataformat import DatasetReplica, BlockReplica, Site, Group, Configuration
+from dynamo.dataformat import DatasetReplica, BlockReplica, Site, Group, Configuration, OperationalError
 
 LOG = logging.getLogger(__name__)
 
@@ -18,7 +21,8 @@ class PhEDExDeletionInterface(DeletionInterface):
 
         DeletionInterface.__init__(self, config)
 
-        self._phedex = PhEDEx(config.get('phedex', None))
+        self._phedex_config = config.get('phedex', None)
+        self._phedex = PhEDEx(self._phedex_config)
 
         self._history = HistoryDatabase(config.get('history', None))
 
@@ -26,165 +30,344 @@ class PhEDExDeletionInterface(DeletionInterface):
         self.allow_tape_deletion = config.get('allow_tape_deletion', False)
         self.tape_auto_approval = config.get('tape_auto_approval', False)
 
+        # requests are bin-packed into chunks of at most chunk_size TB and chunk_items datasets or blocks
         self.deletion_chunk_size = config.get('chunk_size', 50.) * 1.e+12
+        self.deletion_chunk_items = config.get('chunk_items', 1000)
+        self._parallel_config = config.get('parallel', Configuration())
+
+        # deletion status: number of request ids per deleterequests call, re-poll backoff for undecided requests (seconds),
+        # the file where the decided requests are kept across runs, and how long requests that are not asked for
+        # any more are kept in it (seconds)
+        self.status_chunk_size = config.get('status_chunk_size', 500)
+        self.pending_backoff = config.get('pending_backoff', 300)
+        self.pending_backoff_max = config.get('pending_backoff_max', 6 * 3600)
+        self._status_cache_path = config.get('status_cache_path', None)
+        self.status_retention = config.get('status_retention', 30 * 24 * 3600)
+        self._decided = None
+        self._pending = None
+        self._requested = None
 
     def schedule_deletions(self, replica_list, operation_id, comments = ''): #override
         sites = set(r.site for r, b in replica_list)
         if len(sites) != 1:
-            raise OperationalError('schedule_copies should be called with a list of replicas at a single site.')
+            raise OperationalError('schedule_deletions should be called with a list of replicas at a single site.')
 
-        site = list(sites)[0]
+        return self.schedule_deletions_bulk({operation_id: replica_list}, comments)[operation_id]
 
-        if site.storage_type == Site.TYPE_MSS and not self.allow_tape_deletion:
-            LOG.warning('Deletion from MSS not allowed by configuration.')
-            return []
+    def schedule_deletions_bulk(self, replica_lists, comments = ''):
+        """
+        Schedule deletions for many operations and sites at once. Deletion chunks of all sites are submitted
+        (and approved) concurrently by at most parallel.num_threads workers, and the request ids are recorded in one insert.
+        A chunk that fails does not raise, so the requests made by the other chunks are always recorded.
+        @param replica_lists  {operation id: [(dataset replica, [block replicas] or None)]}
+        @param comments       Comments for all requests
+        @return  {operation id: [(cloned dataset replica, [cloned block replicas] or None)]}
+        """
 
-        # execute the deletions in two steps: one for dataset-level and one for block-level
-        datasets = []
-        blocks = []
+        arg_pool = [] # [((operation id, site, level), options, items)]
 
         # maps used later for cloning
         # getting ugly here.. should come up with a better way of making clones
-        replica_map = {}
-        block_replica_map = {}
+        replica_maps = {} # {operation id: {(dataset, site): replica}}
+        block_replica_map = {} # {(block, site): block replica}
 
-        for dataset_replica, block_replicas in replica_list:
-            if block_replicas is None:
-                datasets.append(dataset_replica.dataset)
+        for operation_id, replica_list in replica_lists.iteritems():
+            # execute the deletions in two steps: one for dataset-level and one for block-level
+            deletion_lists = collections.defaultdict(list) # {(site, level): [datasets or blocks]}
+            replica_map = replica_maps[operation_id] = {}
+
+            for dataset_replica, block_replicas in replica_list:
+                site = dataset_replica.site
+
+                if site.storage_type == Site.TYPE_MSS and not self.allow_tape_deletion:
+                    LOG.warning('Deletion from MSS not allowed by configuration.')
+                    continue
+
+                if block_replicas is None:
+                    deletion_lists[(site, 'dataset')].append(dataset_replica.dataset)
+                else:
+                    deletion_lists[(site, 'block')].extend(br.block for br in block_replicas)
+
+                    replica_map[(dataset_replica.dataset, site)] = dataset_replica
+                    block_replica_map.update(((br.block, site), br) for br in block_replicas)
+
+            for (site, level), items in deletion_lists.iteritems():
+                chunks = pack_items(items, self.deletion_chunk_size, self.deletion_chunk_items)
+
+                LOG.info('Deleting %d %ss from %s in %d chunks (operation %d).', len(items), level, site.name, len(chunks), operation_id)
+
+                options = {
+                    'node': site.name,
+                    'level': level,
+                    'rm_subscriptions': 'y',
+                    'comments': comments
+                }
+
+                for chunk in chunks:
+                    arg_pool.append(((operation_id, site, level), options, chunk))
+
+        deleted_datasets = dict((operation_id, []) for operation_id in replica_lists.iterkeys()) # {operation id: [(dataset, site)]}
+        deleted_blocks = dict((operation_id, []) for operation_id in replica_lists.iterkeys()) # {operation id: [(block, site)]}
+
+        history_entries = []
+
+        # the history DB is written from this thread only
+        for (operation_id, site, level), requests in Map(self._parallel_config).execute(self._run_deletion_request, arg_pool):
+            for request_id, approved, items in requests:
+                LOG.warning('PhEDEx deletion request id: %d', request_id)
+                history_entries.append((request_id, 'deletion', operation_id, approved))
+
+                if not approved:
+                    continue
+
+                if level == 'dataset':
+                    deleted_datasets[operation_id].extend((dataset, site) for dataset in items)
+                else:
+                    deleted_blocks[operation_id].extend((block, site) for block in items)
+
+        if not self._read_only and len(history_entries) != 0:
+            fields = ('id', 'operation_type', 'operation_id', 'approved')
+            self._history.db.insert_many('phedex_requests', fields, None, history_entries, do_update = False)
+
+        result = {}
+
+        for operation_id in replica_lists.iterkeys():
+            success = result[operation_id] = []
+
+            for dataset, site in deleted_datasets[operation_id]:
+                replica = DatasetReplica(dataset, site, growing = False, group = Group.null_group)
+                success.append((replica, None))
+
+            tmp_map = dict((key, []) for key in replica_maps[operation_id].iterkeys())
+
+            for block, site in deleted_blocks[operation_id]:
+                tmp_map[(block.dataset, site)].append(block)
+
+            for (dataset, site), blocks in tmp_map.iteritems():
+                replica = DatasetReplica(dataset, site)
+                replica.copy(replica_maps[operation_id][(dataset, site)])
+
+                success.append((replica, []))
+                for block in blocks:
+                    block_replica = BlockReplica(block, site, Group.null_group)
+                    block_replica.copy(block_replica_map[(block, site)])
+                    block_replica.last_update = int(time.time())
+                    success[-1][1].append(block_replica)
+
+        return result
+
+    def _run_deletion_request(self, key, options, items):
+        # an exception in a worker would abort the whole map and lose the request ids of the other chunks
+        try:
+            return key, self._delete(options, items)
+        except:
+            LOG.error('Deletion of %d %ss from %s failed.', len(items), options['level'], options['node'])
+            return key, []
+
+    def _delete(self, options, items):
+        """
+        Make a deletion request for one chunk and approve it if configured. If PhEDEx rejects the data (error 400),
+        the chunk is bisected until the offending item is isolated; the other items are deleted.
+        @param options  Request options except for data
+        @param items    List of datasets or blocks
+        @return  [(request id, approved, items)]
+        """
+
+        # a PhEDEx instance per call so that last_errorcode is not shared between threads
+        phedex = PhEDEx(self._phedex_config)
+
+        writer = phedex.catalog_writer()
+        for item in items:
+            writer.add(item)
+
+        request_options = dict(options)
+        request_options['data'] = writer.getvalue()
+
+        # result = [{'id': <id>}] (item 'request_created' of PhEDEx response) if successful
+        try:
+            if self._read_only:
+                result = [{'id': 0}]
             else:
-                blocks.extend(br.block for br in block_replicas)
+                result = phedex.make_request('delete', request_options, method = POST)
+        except:
+            LOG.error('Deletion %s failed.', str(request_options))
+
+            if phedex.last_errorcode == 400:
+                # Sometimes we have invalid data in the list of objects to delete.
+                # PhEDEx throws a 400 error in such a case. We have to then try to identify the
+                # problematic item through trial and error.
+                if len(items) == 1:
+                    LOG.error('Could not delete %s from %s', str(items[0]), options['node'])
+                    return []
+                else:
+                    LOG.info('Retrying with a reduced item list.')
+                    return self._delete(options, items[:len(items) / 2]) + self._delete(options, items[len(items) / 2:])
+            else:
+                raise
 
-                replica_map[dataset_replica.dataset] = dataset_replica
-                block_replica_map.update((br.block, br) for br in block_replicas)
+        request_id = int(result[0]['id']) # return value is a string
 
-        success = []
+        approved = False
 
-        deleted_datasets = self._run_deletion_request(operation_id, site, 'dataset', datasets, comments)
+        if self._read_only:
+            approved = True
 
-        for dataset in deleted_datasets:
-            replica = DatasetReplica(dataset, site, growing = False, group = Group.null_group)
-            success.append((replica, None))
+        elif self.auto_approval:
+            try:
+                result = phedex.make_request('updaterequest', {'decision': 'approve', 'request': request_id, 'node': options['node']}, method = POST)
+            except:
+                LOG.error('deletion approval of request %d failed.', request_id)
+            else:
+                approved = True
 
-        tmp_map = dict((dataset, []) for dataset in replica_map.iterkeys())
+        return [(request_id, approved, items)]
 
-        deleted_blocks = self._run_deletion_request(operation_id, site, 'block', blocks, comments)
+    def deletion_status(self, request_id): #override
+        return self.deletion_status_bulk([request_id])[request_id]
 
-        for block in deleted_blocks:
-            tmp_map[block.dataset].append(block)
+    def deletion_status_bulk(self, request_ids):
+        """
+        Get the status of many deletion requests. Decided requests are cached (decisions do not change) until they
+        have not been asked for during status_retention seconds; undecided requests are re-polled with an exponential
+        backoff, starting at pending_backoff seconds up to pending_backoff_max seconds. Requests to poll are fetched
+        in chunks of status_chunk_size ids per deleterequests call. The cache file is rewritten only when it changed.
+        @param request_ids  List of request ids
+        @return  {request id: {dataset name: (bytes, bytes, time decided)}}. Undecided requests have empty status.
+        """
 
-        for dataset, blocks in tmp_map.iteritems():
-            replica = DatasetReplica(dataset, site)
-            replica.copy(replica_map[dataset])
-            
-            success.append((replica, []))
-            for block in blocks:
-                block_replica = BlockReplica(block, site, Group.null_group)
-                block_replica.copy(block_replica_map[block])
-                block_replica.last_update = int(time.time())
-                success[-1][1].append(block_replica)
+        self._load_status_cache()
 
-        return success
+        now = time.time()
 
-    def _run_deletion_request(self, operation_id, site, level, deletion_list, comments):
-        full_catalog = collections.defaultdict(list)
+        # the cache needs saving if entries were evicted, decided, or backed off, or if the saved request times are getting stale
+        modified = self._evict_status_cache(now)
 
-        if level == 'dataset':
-            for dataset in deletion_list:
-                full_catalog[dataset] = []
-        elif level == 'block':
-            for block in deletion_list:
-                full_catalog[block.dataset].append(block)
+        result = {}
+        to_poll = []
 
-        history_sql = 'INSERT INTO `phedex_requests` (`id`, `operation_type`, `operation_id`, `approved`) VALUES (%s, \'deletion\', %s, %s)'
+        for request_id in request_ids:
+            if now - self._requested.get(request_id, 0) > self.status_retention / 2:
+                modified = True
+            self._requested[request_id] = now
 
-        deleted_items = []
+            try:
+                result[request_id] = self._decided[request_id]
+                continue
+            except KeyError:
+                pass
 
-        request_catalog = {}
-        chunk_size = 0
-        items = []
-        while len(full_catalog) != 0:
-            dataset, blocks = full_catalog.popitem()
-            request_catalog[dataset] = blocks
+            result[request_id] = {}
 
-            if level == 'dataset':
-                chunk_size += dataset.size
-                items.append(dataset)
-            elif level == 'block':
-                chunk_size += sum(b.size for b in blocks)
-                items.extend(blocks)
+            try:
+                next_poll, backoff = self._pending[request_id]
+            except KeyError:
+                to_poll.append(request_id)
+            else:
+                if now >= next_poll:
+                    to_poll.append(request_id)
 
-            if chunk_size < self.deletion_chunk_size and len(full_catalog) != 0:
+        LOG.debug('Deletion status: %d requests to poll, %d decided or waiting.', len(to_poll), len(request_ids) - len(to_poll))
+
+        chunks = [(to_poll[i:i + self.status_chunk_size],) for i in xrange(0, len(to_poll), self.status_chunk_size)]
+
+        decided = set()
+
+        for requests in Map(self._parallel_config).execute(self._get_delete_requests, chunks):
+            for request in requests:
+                request_id = int(request['id'])
+
+                nodes = request['nodes']['node']
+                if len(nodes) == 0 or any('decided_by' not in node for node in nodes):
+                    continue
+
+                last_update = max(node['decided_by']['time_decided'] for node in nodes)
+
+                status = {}
+                for ds_entry in request['data']['dbs']['dataset']:
+                    status[ds_entry['name']] = (ds_entry['bytes'], ds_entry['bytes'], last_update)
+
+                self._decided[request_id] = result[request_id] = status
+                self._pending.pop(request_id, None)
+                decided.add(request_id)
+
+        for request_id in to_poll:
+            if request_id in decided:
                 continue
 
-            options = {
-                'node': site.name,
-                'data': self._phedex.form_catalog_xml(request_catalog),
-                'level': level,
-                'rm_subscriptions': 'y',
-                'comments': comments
-            }
-    
-            # result = [{'id': <id>}] (item 'request_created' of PhEDEx response) if successful
             try:
-                if self._read_only:
-                    result = [{'id': 0}]
-                else:
-                    result = self._phedex.make_request('delete', options, method = POST)
-            except:
-                LOG.error('Deletion %s failed.', str(options))
-
-                if self._phedex.last_errorcode == 400:
-                    # Sometimes we have invalid data in the list of objects to delete.
-                    # PhEDEx throws a 400 error in such a case. We have to then try to identify the
-                    # problematic item through trial and error.
-                    if len(items) == 1:
-                        LOG.error('Could not delete %s from %s', str(items[0]), site.name)
-                    else:
-                        LOG.info('Retrying with a reduced item list.')
-                        deleted_items.extend(self._run_deletion_request(operation_id, site, level, items[:len(items) / 2], comments))
-                        deleted_items.extend(self._run_deletion_request(operation_id, site, level, items[len(items) / 2:], comments))
-                else:
-                    raise
+                next_poll, backoff = self._pending[request_id]
+            except KeyError:
+                backoff = self.pending_backoff
             else:
-                request_id = int(result[0]['id']) # return value is a string
-                LOG.warning('PhEDEx deletion request id: %d', request_id)
+                backoff = min(backoff * 2, self.pending_backoff_max)
 
-                approved = False
+            self._pending[request_id] = (now + backoff, backoff)
+            modified = True
 
-                if self._read_only:
-                    approved = True
+        if modified or len(decided) != 0:
+            self._save_status_cache()
 
-                elif self.auto_approval:
-                    try:
-                        result = self._phedex.make_request('updaterequest', {'decision': 'approve', 'request': request_id, 'node': site.name}, method = POST)
-                    except:
-                        LOG.error('deletion approval of request %d failed.', request_id)
-                    else:
-                        approved = True
+        return result
 
-                if not self._read_only:
-                    self._history.db.query(history_sql, request_id, operation_id, approved)
+    def _get_delete_requests(self, request_ids):
+        return self._phedex.make_request('deleterequests', [('request', i) for i in request_ids], method = POST)
 
-                if approved:
-                    deleted_items.extend(items)
+    def _load_status_cache(self):
+        if self._decided is not None:
+            return
 
-            request_catalog = {}
-            chunk_size = 0
-            items = []
+        self._decided = {} # {request id: status}
+        self._pending = {} # {request id: (next poll time, backoff)}
+        self._requested = {} # {request id: last time the status was asked for}
 
-        return deleted_items
+        if self._status_cache_path is None:
+            return
 
-    def deletion_status(self, request_id): #override
-        request = self._phedex.make_request('deleterequests', 'request=%d' % request_id)
-        if len(request) == 0:
-            return {}
-
-        node_info = request[0]['nodes']['node'][0]
-        site_name = node_info['name']
-        last_update = node_info['decided_by']['time_decided']
-
-        status = {}
-        for ds_entry in request[0]['data']['dbs']['dataset']:
-            status[ds_entry['name']] = (ds_entry['bytes'], ds_entry['bytes'], last_update)
-            
-        return status
+        try:
+            with open(self._status_cache_path) as source:
+                cache = json.load(source)
+        except (IOError, ValueError):
+            return
+
+        for request_id, status in cache['decided'].iteritems():
+            self._decided[int(request_id)] = dict((str(name), tuple(entry)) for name, entry in status.iteritems())
+
+        for request_id, (next_poll, backoff) in cache['pending'].iteritems():
+            self._pending[int(request_id)] = (next_poll, backoff)
+
+        # caches written before the retention was introduced have no request times
+        now = time.time()
+        requested = cache.get('requested', {})
+        for request_id in self._decided.keys() + self._pending.keys():
+            self._requested[request_id] = requested.get(str(request_id), now)
+
+    def _evict_status_cache(self, now):
+        """
+        Drop the requests that have not been asked for during status_retention seconds.
+        @param now  Current time
+        @return  True if any request was dropped
+        """
+
+        evicted = [request_id for request_id, last_requested in self._requested.iteritems() if now - last_requested > self.status_retention]
+
+        for request_id in evicted:
+            self._requested.pop(request_id)
+            self._decided.pop(request_id, None)
+            self._pending.pop(request_id, None)
+
+        if len(evicted) != 0:
+            LOG.debug('Evicted %d requests from the deletion status cache.', len(evicted))
+
+        return len(evicted) != 0
+
+    def _save_status_cache(self):
+        if self._status_cache_path is None:
+            return
+
+        cache = {'decided': self._decided, 'pending': self._pending, 'requested': self._requested}
+
+        tmp_path = self._status_cache_path + '.tmp'
+        with open(tmp_path, 'w') as output:
+            json.dump(cache, output)
+
+        os.rename(tmp_path, self._status_cache_path)
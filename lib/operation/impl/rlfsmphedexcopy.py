@@ -8,6 +8,28 @@ from dynamo.utils.interface.mysql import MySQL
 
 LOG = logging.getLogger(__name__)
 
+def missing_block_files(block_replica):
+    """
+    Files of the block not in the replica. The block files are matched against the file id list of the replica
+    (LFN for files with id 0) instead of building the File set of the replica.
+    @param block_replica  BlockReplica with file_ids not None
+    @return  List of files
+    """
+
+    present = set(block_replica.file_ids)
+    return [f for f in block_replica.block.files if (f.lfn if f.id == 0 else f.id) not in present]
+
+def subscribe_files(rlfsm, site, files):
+    """
+    Subscribe many files to a site through RLFSM.subscribe_file.
+    @param rlfsm  RLFSM
+    @param site   Site
+    @param files  List of files
+    """
+
+    for lfile in files:
+        rlfsm.subscribe_file(site, lfile)
+
 class RLFSMPhEDExReserveCopyInterface(CopyInterface):
     """
     CopyInterface using the Dynamo RLFSM.
@@ -30,6 +52,7 @@ class RLFSMPhEDExReserveCopyInterface(CopyInterface):
         LOG.info('Scheduling copy of %d replicas to %s using RLFSM (operation %d)', len(replica_list), list(sites)[0], operation_id)
 
         result = []
+        missing_files = []
 
         for replica in replica_list:
             # Function spec is to return clones (so that if specific block fails to copy, we can return a dataset replica without the block)
@@ -38,30 +61,32 @@ class RLFSMPhEDExReserveCopyInterface(CopyInterface):
             result.append(clone_replica)
 
             for block_replica in replica.block_replicas:
-                LOG.debug('Subscribing files for %s', str(block_replica))
-
                 if block_replica.file_ids is None:
                     LOG.debug('No file to subscribe for %s', str(block_replica))
-                    return
-        
-                all_files = block_replica.block.files
-                missing_files = all_files - block_replica.files()
-
-                for lfile in missing_files:
-                    self.rlfsm.subscribe_file(block_replica.site, lfile)
+                else:
+                    LOG.debug('Subscribing files for %s', str(block_replica))
+                    missing_files.extend(missing_block_files(block_replica))
 
                 clone_block_replica = BlockReplica(block_replica.block, block_replica.site, block_replica.group)
                 clone_block_replica.copy(block_replica)
                 clone_block_replica.last_update = int(time.time())
                 clone_replica.block_replicas.add(clone_block_replica)
 
+        if len(missing_files) != 0:
+            subscribe_files(self.rlfsm, list(sites)[0], missing_files)
+
         if not self._read_only:
+            reservations = []
             for clone_replica in result:
                 if clone_replica.growing:
-                    self.mysql.query('INSERT INTO `phedex_transfer_reservations` (`operation_id`, `item`, `site`, `group`) VALUES (%s, %s, %s, %s)', operation_id, clone_replica.dataset.name, clone_replica.site.name, clone_replica.group.name)
+                    reservations.append((operation_id, clone_replica.dataset.name, clone_replica.site.name, clone_replica.group.name))
                 else:
                     for block_replica in clone_replica.block_replicas:
-                        self.mysql.query('INSERT INTO `phedex_transfer_reservations` (`operation_id`, `item`, `site`, `group`) VALUES (%s, %s, %s, %s)', operation_id, block_replica.block.full_name(), clone_replica.site.name, block_replica.group.name)
+                        reservations.append((operation_id, block_replica.block.full_name(), clone_replica.site.name, block_replica.group.name))
+
+            if len(reservations) != 0:
+                fields = ('operation_id', 'item', 'site', 'group')
+                self.mysql.insert_many('phedex_transfer_reservations', fields, None, reservations, do_update = False)
 
         # no external dependency - everything is a success
         return result
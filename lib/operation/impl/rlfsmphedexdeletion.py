@@ -2,12 +2,39 @@ import time
 import logging
 
 from dynamo.operation.deletion import DeletionInterface
+from dynamo.operation.impl.phedexdeletion import PhEDExDeletionInterface
 from dynamo.dataformat import DatasetReplica, BlockReplica, OperationalError
 from dynamo.fileop.rlfsm import RLFSM
 from dynamo.utils.interface.mysql import MySQL
+from dynamo.history.history import HistoryDatabase
 
 LOG = logging.getLogger(__name__)
 
+def block_replica_files(block_replica):
+    """
+    Files of the block replica, taken from the block file list and the file id list of the replica
+    (LFN for files with id 0) without building the File set of the replica.
+    @param block_replica  BlockReplica
+    @return  List of files
+    """
+
+    if block_replica.file_ids is None:
+        return list(block_replica.block.files)
+
+    present = set(block_replica.file_ids)
+    return [f for f in block_replica.block.files if (f.lfn if f.id == 0 else f.id) in present]
+
+def desubscribe_files(rlfsm, site, files):
+    """
+    Desubscribe many files from a site through RLFSM.desubscribe_file.
+    @param rlfsm  RLFSM
+    @param site   Site
+    @param files  List of files
+    """
+
+    for lfile in files:
+        rlfsm.desubscribe_file(site, lfile)
+
 class RLFSMPhEDExReserveDeletionInterface(DeletionInterface):
     """
     DeletionInterface using the Dynamo RLFSM.
@@ -18,9 +45,17 @@ class RLFSMPhEDExReserveDeletionInterface(DeletionInterface):
         self.rlfsm = RLFSM(config.get('rlfsm', None))
         self.mysql = MySQL(config.reserve_db_params)
 
+        # completed deletions are reported to PhEDEx by the updater under the same operation id
+        self._history = HistoryDatabase(config.get('history', None))
+        self._phedex_deletion = PhEDExDeletionInterface(config.get('phedex_deletion', None))
+
+        # number of operation ids per query in deletion status
+        self.status_chunk_size = config.get('status_chunk_size', 500)
+
     def set_read_only(self, value = True): #override
         self._read_only = value
         self.rlfsm.set_read_only(value)
+        self._phedex_deletion.set_read_only(value)
 
     def schedule_deletions(self, replica_list, operation_id, comments = ''): #override
         sites = set(r.site for r, b in replica_list)
@@ -32,6 +67,7 @@ class RLFSMPhEDExReserveDeletionInterface(DeletionInterface):
         LOG.info('Scheduling deletion of %d replicas from %s using RLFSM (operation %d)', len(replica_list), site.name, operation_id)
 
         clones = []
+        files = []
 
         for dataset_replica, block_replicas in replica_list:
             if block_replicas is None:
@@ -40,8 +76,7 @@ class RLFSMPhEDExReserveDeletionInterface(DeletionInterface):
                 to_delete = block_replicas
 
             for block_replica in to_delete:
-                for lfile in block_replica.files():
-                    self.rlfsm.desubscribe_file(block_replica.site, lfile)
+                files.extend(block_replica_files(block_replica))
 
             # No external dependency -> all operations are successful
 
@@ -58,15 +93,64 @@ class RLFSMPhEDExReserveDeletionInterface(DeletionInterface):
                     clone_block_replica.last_update = int(time.time())
                     clones[-1][1].append(clone_block_replica)
 
+        desubscribe_files(self.rlfsm, site, files)
+
         if not self._read_only:
+            reservations = []
             for clone_replica, block_replicas in clones:
                 if block_replicas is None:
-                    self.mysql.query('INSERT INTO `phedex_deletion_reservations` (`operation_id`, `item`, `site`) VALUES (%s, %s, %s)', operation_id, clone_replica.dataset.name, clone_replica.site.name)
+                    reservations.append((operation_id, clone_replica.dataset.name, clone_replica.site.name))
                 else:
                     for block_replica in block_replicas:
-                        self.mysql.query('INSERT INTO `phedex_deletion_reservations` (`operation_id`, `item`, `site`) VALUES (%s, %s, %s)', operation_id, block_replica.block.full_name(), clone_replica.site.name)
+                        reservations.append((operation_id, block_replica.block.full_name(), clone_replica.site.name))
+
+            if len(reservations) != 0:
+                fields = ('operation_id', 'item', 'site')
+                self.mysql.insert_many('phedex_deletion_reservations', fields, None, reservations, do_update = False)
 
         return clones
 
     def deletion_status(self, operation_id): #override
-        raise NotImplementedError('deletion_status')
+        return self.deletion_status_bulk([operation_id])[operation_id]
+
+    def deletion_status_bulk(self, operation_ids):
+        """
+        Deletion status of many operations. Items still in the reservations table are pending (nothing deleted yet;
+        sizes from the block sizes of the inventory database). The updater removes the reservation of an item once its
+        deletion is complete and reports it to PhEDEx with a deletion request under the same operation id, so the
+        completed items and their sizes are taken from the PhEDEx deletion requests of the operation.
+        @param operation_ids  List of deletion operation ids
+        @return  {operation id: {dataset or block name: (size, deleted size, last update)}}
+        """
+
+        status = dict((operation_id, {}) for operation_id in operation_ids)
+
+        request_ids = {} # {PhEDEx request id: operation id}
+
+        # item is a dataset name or a block full name (dataset#block)
+        sql = 'SELECT r.`operation_id`, r.`item`, IFNULL(SUM(b.`size`), 0) FROM `phedex_deletion_reservations` AS r'
+        sql += ' LEFT JOIN `datasets` AS d ON d.`name` = SUBSTRING_INDEX(r.`item`, \'#\', 1)'
+        sql += ' LEFT JOIN `blocks` AS b ON b.`dataset_id` = d.`id` AND (LOCATE(\'#\', r.`item`) = 0 OR b.`name` = SUBSTRING(r.`item`, LOCATE(\'#\', r.`item`) + 1))'
+        sql += ' WHERE r.`operation_id` IN (%s) GROUP BY r.`id`'
+
+        history_sql = 'SELECT `id`, `operation_id` FROM `phedex_requests` WHERE `operation_type` = \'deletion\' AND `operation_id` IN (%s)'
+
+        pending = [] # [(operation id, item name, size)]
+
+        for i in xrange(0, len(operation_ids), self.status_chunk_size):
+            chunk = ','.join('%d' % operation_id for operation_id in operation_ids[i:i + self.status_chunk_size])
+
+            for request_id, operation_id in self._history.db.xquery(history_sql % chunk):
+                request_ids[request_id] = operation_id
+
+            pending.extend(self.mysql.xquery(sql % chunk))
+
+        if len(request_ids) != 0:
+            for request_id, request_status in self._phedex_deletion.deletion_status_bulk(request_ids.keys()).iteritems():
+                status[request_ids[request_id]].update(request_status)
+
+        # reservations last so that an item completed in one request and reserved again is reported as pending
+        for operation_id, item_name, size in pending:
+            status[operation_id][item_name] = (int(size), 0, None)
+
+        return status
@@ -4,14 +4,21 @@ import collections
 import logging
 import fnmatch
 import MySQLdb
+import numpy as np
 
 from dynamo.utils.interface.popdb import PopDB
 from dynamo.history.history import HistoryDatabase
+from dynamo.history.accesscache import DatasetAccessCache
+from dynamo.policy.resultcache import ProducerResultCache
 from dynamo.dataformat import Configuration, Site
 from dynamo.utils.parallel import Map
 
 LOG = logging.getLogger(__name__)
 
+# Stored access records in columns. dataset_index points into the datasets list and is non-decreasing,
+# i.e. the records of each dataset are contiguous.
+AccessColumns = collections.namedtuple('AccessColumns', ['datasets', 'dataset_index', 'timestamps', 'counts'])
+
 class CRABAccessHistory(object):
     """
     Sets two attrs:
@@ -37,6 +44,22 @@ class CRABAccessHistory(object):
 
         self.max_back_query = config.get('max_back_query', 7)
 
+        # PopDB requests are made in parallel; access records are saved to the DB every save_batch_size records
+        self._parallel_config = config.get('parallel', Configuration())
+        self.save_batch_size = config.get('save_batch_size', 50000)
+
+        # local aggregate of the access records; if not set, all records are read from the DB at each load
+        if config.get('access_cache', None):
+            self._access_cache = DatasetAccessCache(config.access_cache)
+        else:
+            self._access_cache = None
+
+        # computed attrs shared with the other runs of a sequence while the popularity data is unchanged
+        if config.get('result_cache', None):
+            self._result_cache = ProducerResultCache(config.result_cache)
+        else:
+            self._result_cache = None
+
         self.included_sites = list(config.get('include_sites', []))
         self.excluded_sites = list(config.get('exclude_sites', []))
 
@@ -47,29 +70,54 @@ class CRABAccessHistory(object):
         self._history.set_read_only(value)
 
     def load(self, inventory):
+        if self._result_cache is not None:
+            try:
+                stamp = str(self._history.db.query('SELECT UNIX_TIMESTAMP(`dataset_accesses_last_update`) FROM `popularity_last_update`')[0])
+            except IndexError:
+                stamp = ''
+
+            if self._result_cache.load(self, inventory, stamp):
+                return
+
         records = self._get_stored_records(inventory)
         self._compute(inventory, records)
 
+        if self._result_cache is not None:
+            self._result_cache.save(self, inventory, stamp)
+
     def _get_stored_records(self, inventory):
         """
         Get the replica access data from DB.
         @param inventory  DynamoInventory
-        @return  {dataset: [(date, number of access)]}
+        @return  AccessColumns (datasets, dataset index, date, number of access)
         """
 
-        # pick up all accesses that are less than 2 years old
-        # old accesses will be removed automatically next time the access information is saved from memory
-        sql = 'SELECT d.`name`, UNIX_TIMESTAMP(a.`date`), a.`num_accesses` FROM `dataset_accesses` AS a'
-        sql += ' INNER JOIN `datasets` AS d ON d.`id` = a.`dataset_id`'
-        sql += ' WHERE a.`date` > DATE_SUB(NOW(), INTERVAL 2 YEAR) ORDER BY d.`id`, a.`date`'
+        if not self._summary_empty():
+            if self._access_cache is not None:
+                return self._get_cached_records(inventory)
 
-        all_accesses = {}
+            # pick up all accesses that are less than 2 years old from the daily rollup
+            # old months will be dropped automatically next time the access information is saved from memory
+            sql = 'SELECT d.`name`, UNIX_TIMESTAMP(a.`date`), a.`num_accesses` FROM `dataset_access_summary` AS a'
+            sql += ' INNER JOIN `datasets` AS d ON d.`id` = a.`dataset_id`'
+            sql += ' WHERE a.`date` > DATE_SUB(NOW(), INTERVAL 2 YEAR) ORDER BY d.`id`, a.`date`'
+        else:
+            # the rollup is filled at the next update; the access cache is built from the rollup and must not be
+            # initialized from an empty one
+            LOG.warning('Dataset access summary is empty. Reading the raw access records.')
+            sql = 'SELECT d.`name`, UNIX_TIMESTAMP(a.`date`), SUM(a.`num_accesses`) FROM `dataset_accesses` AS a'
+            sql += ' INNER JOIN `datasets` AS d ON d.`id` = a.`dataset_id`'
+            sql += ' WHERE a.`date` > DATE_SUB(NOW(), INTERVAL 2 YEAR) GROUP BY d.`id`, a.`date` ORDER BY d.`id`, a.`date`'
+
+        datasets = []
+        dataset_index = []
+        timestamps = []
+        counts = []
         num_records = 0
 
-        # little speedup by not repeating lookups for the same replica
+        # little speedup by not repeating lookups for the same dataset
         current_dataset_name = ''
         dataset_exists = True
-        replica = None
         for dataset_name, timestamp, num_accesses in self._history.db.xquery(sql):
             num_records += 1
 
@@ -87,9 +135,11 @@ class CRABAccessHistory(object):
                 else:
                     dataset_exists = True
 
-                accesses = all_accesses[dataset] = []
+                datasets.append(dataset)
 
-            accesses.append((timestamp, num_accesses))
+            dataset_index.append(len(datasets) - 1)
+            timestamps.append(timestamp)
+            counts.append(num_accesses)
 
         try:
             last_update = self._history.db.query('SELECT UNIX_TIMESTAMP(`dataset_accesses_last_update`) FROM `popularity_last_update`')[0]
@@ -98,46 +148,101 @@ class CRABAccessHistory(object):
 
         LOG.info('Loaded %d replica access data. Last update on %s UTC', num_records, time.strftime('%Y-%m-%d', time.gmtime(last_update)))
 
-        return all_accesses
+        return AccessColumns(datasets, np.array(dataset_index, dtype = np.int64), np.array(timestamps, dtype = np.float64), np.array(counts, dtype = np.int64))
 
-    def _compute(self, inventory, all_accesses):
+    def _get_cached_records(self, inventory):
+        """
+        Get the replica access data aggregated per dataset from the access cache. Each dataset has a single
+        record with the total number of accesses and the last access date, which gives the same result in _compute.
+        @param inventory  DynamoInventory
+        @return  AccessColumns
+        """
+
+        names, num_accesses, last_access = self._access_cache.load(self._history.db)
+
+        datasets = []
+        positions = []
+        for i, name in enumerate(names):
+            try:
+                datasets.append(inventory.datasets[name])
+            except KeyError:
+                continue
+
+            positions.append(i)
+
+        positions = np.array(positions, dtype = np.int64)
+
+        LOG.info('Loaded replica access data of %d datasets from the access cache.', len(names))
+
+        return AccessColumns(datasets, np.arange(len(datasets), dtype = np.int64), last_access[positions].astype(np.float64), num_accesses[positions])
+
+    def _compute(self, inventory, accesses):
         """
         Set the dataset usage rank based on access list.
         nAccessed is NACC normalized by size (in GB).
+        Per-dataset totals and the rank formula are evaluated as array operations; only the final values are set to the attrs.
         @param inventory   DynamoInventory
-        @param all_accesses {dataset: [(date, number of access)]} (time ordered)
+        @param accesses    AccessColumns
         """
 
         now = time.time()
-        today = datetime.datetime.utcfromtimestamp(now).date()
 
-        for dataset in inventory.datasets.itervalues():
-            last_access = 0
-            num_access = 0
-            norm_access = 0.
+        datasets = list(inventory.datasets.itervalues())
+        num_datasets = len(datasets)
 
-            try:
-                accesses = all_accesses[dataset]
-            except KeyError:
-                pass
-            else:
-                last_access = accesses[-1][0]
-                num_access = sum(e[1] for e in accesses)
-                if dataset.size != 0:
-                    norm_access = float(num_access) / (dataset.size * 1.e-9)
+        # map the access columns to positions in the full dataset list
+        position = dict((dataset, i) for i, dataset in enumerate(datasets))
+        accessed = np.array([position[d] for d in accesses.datasets], dtype = np.int64)
 
-            try:
-                last_block_created = max(r.last_block_created() for r in dataset.replicas)
-            except ValueError: # empty sequence
-                last_block_created = 0
+        num_access = np.zeros(num_datasets, dtype = np.int64)
+        last_access = np.zeros(num_datasets, dtype = np.float64)
+
+        if len(accessed) != 0:
+            # records of a dataset are contiguous; reduce over each group (no sorting needed)
+            group_start = np.flatnonzero(np.diff(np.append(-1, accesses.dataset_index)) != 0)
+            group_datasets = accessed[accesses.dataset_index[group_start]]
+
+            num_access[group_datasets] = np.add.reduceat(accesses.counts, group_start)
+            last_access[group_datasets] = np.maximum.reduceat(accesses.timestamps, group_start)
+
+        # dataset properties that are not part of the access columns; one pass over the datasets
+        sizes = []
+        last_updates = []
+        last_blocks_created = []
+        for dataset in datasets:
+            sizes.append(dataset.size)
+            last_updates.append(dataset.last_update)
+
+            last_block_created = 0
+            for replica in dataset.replicas:
+                created = replica.last_block_created()
+                if created > last_block_created:
+                    last_block_created = created
+
+            last_blocks_created.append(last_block_created)
 
-            last_change = max(last_access, dataset.last_update, last_block_created)
+        size = np.array(sizes, dtype = np.float64)
+        last_update = np.array(last_updates, dtype = np.float64)
+        last_block_created = np.array(last_blocks_created, dtype = np.float64)
 
-            rank = (now - last_change) / (24. * 3600.) - norm_access
+        norm_access = np.zeros(num_datasets, dtype = np.float64)
+        nonzero = size != 0
+        norm_access[nonzero] = num_access[nonzero] / (size[nonzero] * 1.e-9)
 
-            dataset.attr['global_usage_rank'] = rank
-            dataset.attr['num_access'] = num_access
-            dataset.attr['last_access'] = max(last_access, dataset.last_update)
+        last_change = np.maximum(np.maximum(last_access, last_update), last_block_created)
+
+        rank = (now - last_change) / (24. * 3600.) - norm_access
+        attr_last_access = np.maximum(last_access, last_update).astype(np.int64)
+
+        rank = rank.tolist()
+        num_access = num_access.tolist()
+        attr_last_access = attr_last_access.tolist()
+
+        for i in xrange(num_datasets):
+            attr = datasets[i].attr
+            attr['global_usage_rank'] = rank[i]
+            attr['num_access'] = num_access[i]
+            attr['last_access'] = attr_last_access[i]
 
     def update(self, inventory):
         try:
@@ -159,20 +264,136 @@ class CRABAccessHistory(object):
         start_time = max(last_update, (time.time() - 3600 * 24 * self.max_back_query))
         start_date = datetime.date(*time.gmtime(start_time)[:3])
 
-        source_records = self._get_source_records(inventory, start_date)
+        self._ingest(inventory, start_date)
 
         if not self._read_only:
-            self._save_records(source_records)
-            # remove old entries
+            self._update_summary(start_date)
+            if self._access_cache is not None:
+                # records from start_date on were rewritten
+                self._access_cache.invalidate(start_date)
             self._history.db.query('DELETE FROM `dataset_accesses` WHERE `date` < DATE_SUB(NOW(), INTERVAL 2 YEAR)')
             self._history.db.query('UPDATE `popularity_last_update` SET `dataset_accesses_last_update` = NOW()')
 
-    def _get_source_records(self, inventory, start_date):
+    def _update_summary(self, start_date):
+        """
+        Recompute the daily per-dataset rollup (dataset_access_summary) from start_date and manage its monthly partitions.
+        Months are added ahead of time, and months entirely older than the retention period are dropped.
+        @param start_date  datetime.date
+        """
+
+        db = self._history.db
+
+        if self._summary_empty():
+            # first update after the summary table was created
+            LOG.info('Dataset access summary is empty. Backfilling from the raw access records.')
+            self._fill_summary(db.query('SELECT MIN(`date`) FROM `dataset_accesses`')[0])
+
+        self._fill_summary(start_date)
+
+        if self._access_cache is None:
+            retention = 24
+        else:
+            # the access cache subtracts the expired entries from its aggregate and needs them for a while longer
+            retention = 24 + DatasetAccessCache.retention_margin
+
+        floor = db.query('SELECT DATE_SUB(CURDATE(), INTERVAL %d MONTH)' % retention)[0]
+
+        # partition pYYYYMM holds the month YYYY-MM; drop it when the first day of the following month is not after the floor
+        expired = []
+        for name in self._get_summary_partitions():
+            if name == 'p_future':
+                continue
+
+            year, month = int(name[1:5]), int(name[5:7])
+            if self._next_month(datetime.date(year, month, 1)) <= floor:
+                expired.append(name)
+
+        if len(expired) != 0:
+            LOG.info('Dropping dataset access summary partitions %s.', ', '.join(expired))
+            db.query('ALTER TABLE `dataset_access_summary` DROP PARTITION ' + ', '.join('`%s`' % name for name in expired))
+
+    def _summary_empty(self):
         """
-        Get the replica access data from PopDB from start_date to today.
+        @return  True if the rollup is empty while there are raw records (before the first update that fills it).
+        """
+
+        db = self._history.db
+
+        if len(db.query('SELECT 1 FROM `dataset_access_summary` LIMIT 1')) != 0:
+            return False
+
+        return len(db.query('SELECT 1 FROM `dataset_accesses` LIMIT 1')) != 0
+
+    def _fill_summary(self, start):
+        """
+        Recompute the rollup rows from start on.
+        @param start  datetime.date
+        """
+
+        start_str = start.strftime('%Y-%m-%d')
+
+        # the partitions must exist before the rows are inserted, otherwise all go into p_future
+        self._add_summary_partitions(start)
+
+        LOG.info('Updating dataset access summary from %s.', start_str)
+
+        sql = 'INSERT INTO `dataset_access_summary` (`dataset_id`, `date`, `num_accesses`, `cputime`)'
+        sql += ' SELECT `dataset_id`, `date`, SUM(`num_accesses`), SUM(`cputime`) FROM `dataset_accesses`'
+        sql += ' WHERE `date` >= %s GROUP BY `dataset_id`, `date`'
+        sql += ' ON DUPLICATE KEY UPDATE `num_accesses` = VALUES(`num_accesses`), `cputime` = VALUES(`cputime`)'
+        self._history.db.query(sql, start_str)
+
+    def _add_summary_partitions(self, start):
+        """
+        Split p_future into monthly partitions from the month of start (or after the last existing month) to next month.
+        @param start  datetime.date
+        """
+
+        existing = [name for name in self._get_summary_partitions() if name != 'p_future']
+
+        if len(existing) == 0:
+            month = datetime.date(start.year, start.month, 1)
+        else:
+            last = max(existing)
+            month = self._next_month(datetime.date(int(last[1:5]), int(last[5:7]), 1))
+
+        utctoday = datetime.date(*time.gmtime()[:3])
+        end = self._next_month(datetime.date(utctoday.year, utctoday.month, 1))
+
+        definitions = []
+        while month <= end:
+            upper = self._next_month(month)
+            definitions.append('PARTITION `p%s` VALUES LESS THAN (TO_DAYS(\'%s\'))' % (month.strftime('%Y%m'), upper.strftime('%Y-%m-%d')))
+            month = upper
+
+        if len(definitions) == 0:
+            return
+
+        definitions.append('PARTITION `p_future` VALUES LESS THAN MAXVALUE')
+
+        sql = 'ALTER TABLE `dataset_access_summary` REORGANIZE PARTITION `p_future` INTO (%s)' % ', '.join(definitions)
+        self._history.db.query(sql)
+
+    def _get_summary_partitions(self):
+        sql = 'SELECT `PARTITION_NAME` FROM `information_schema`.`PARTITIONS`'
+        sql += ' WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = \'dataset_access_summary\''
+        return self._history.db.query(sql)
+
+    @staticmethod
+    def _next_month(date):
+        if date.month == 12:
+            return datetime.date(date.year + 1, 1, 1)
+        else:
+            return datetime.date(date.year, date.month + 1, 1)
+
+    def _ingest(self, inventory, start_date):
+        """
+        Get the replica access data from PopDB from start_date to today and save them to the DB.
+        PopDB gives the accesses summed over the requested time window, so one request is made per (PopDB site, day).
+        Requests are kept in flight by the thread pool, and the results are saved in batches as they come back.
+        Sites that map to the same PopDB site name (e.g. T1 _Disk and _MSS) share the request.
         @param inventory      DynamoInventory
-        @param start_date     Query start date (datetime.datetime)
-        @return  {replica: {date: (number of access, total cpu time)}}
+        @param start_date     Query start date (datetime.date)
         """
 
         days_to_query = []
@@ -185,9 +406,8 @@ class CRABAccessHistory(object):
 
         LOG.info('Updating dataset access info from %s to %s', start_date.strftime('%Y-%m-%d'), utctoday.strftime('%Y-%m-%d'))
 
-        all_accesses = {}
+        popdb_sites = {} # {(service, PopDB site name): [site]}
 
-        arg_pool = []
         for site in inventory.sites.itervalues():
             matched = (len(self.included_sites) == 0)
 
@@ -201,45 +421,77 @@ class CRABAccessHistory(object):
                     matched = False
                     break
 
-            if matched:
-                for date in days_to_query:
-                    arg_pool.append((site, inventory, date))
+            if not matched:
+                continue
+
+            key = self._popdb_site(site)
+            if key is None:
+                continue
+
+            try:
+                popdb_sites[key].append(site)
+            except KeyError:
+                popdb_sites[key] = [site]
 
-        mapper = Map()
+        arg_pool = []
+        for (service, sitename), sites in popdb_sites.iteritems():
+            for date in days_to_query:
+                arg_pool.append((service, sitename, sites, inventory, date))
+
+        LOG.info('Making %d PopDB requests for %d sites.', len(arg_pool), sum(len(s) for s in popdb_sites.itervalues()))
+
+        mapper = Map(self._parallel_config)
         mapper.logger = LOG
 
-        records = mapper.execute(self._get_site_record, arg_pool)
+        # history DB ids are looked up once per name over all batches
+        site_id_map = {}
+        dataset_id_map = {}
+
+        batch = []
+        num_records = 0
+
+        for site_records in mapper.execute(self._get_site_record, arg_pool, async = True):
+            batch.extend(site_records)
 
-        for site_record in records:
-            for replica, date, naccess, cputime in site_record:
-                if replica not in all_accesses:
-                    all_accesses[replica] = {}
+            if len(batch) >= self.save_batch_size:
+                if not self._read_only:
+                    self._save_records(batch, site_id_map, dataset_id_map)
+                num_records += len(batch)
+                batch = []
 
-                all_accesses[replica][date] = (naccess, cputime)
+        if len(batch) != 0:
+            if not self._read_only:
+                self._save_records(batch, site_id_map, dataset_id_map)
+            num_records += len(batch)
 
-        return all_accesses
+        LOG.info('Fetched %d replica access records.', num_records)
 
-    def _get_site_record(self, site, inventory, date):
+    def _popdb_site(self, site):
         """
-        Get the replica access data on a single site from PopDB.
-        @param site       Site
-        @param inventory  Inventory
-        @param date       datetime.date
-        @return [(replica, number of access, total cpu time)]
+        @param site  Site
+        @return  (PopDB service, PopDB site name) or None if the site is not in PopDB
         """
 
         if site.name.startswith('T0'):
-            return []
+            return None
         elif site.name.startswith('T1') and site.name.count('_') > 2:
             nameparts = site.name.split('_')
-            sitename = '_'.join(nameparts[:3])
-            service = 'popularity/DSStatInTimeWindow/' # the trailing slash is apparently important
+            return ('popularity/DSStatInTimeWindow/', '_'.join(nameparts[:3])) # the trailing slash is apparently important
         elif site.name == 'T2_CH_CERN':
-            sitename = site.name
-            service = 'xrdpopularity/DSStatInTimeWindow'
+            return ('xrdpopularity/DSStatInTimeWindow', site.name)
         else:
-            sitename = site.name
-            service = 'popularity/DSStatInTimeWindow/'
+            return ('popularity/DSStatInTimeWindow/', site.name)
+
+    def _get_site_record(self, service, sitename, sites, inventory, date):
+        """
+        Get the replica access data on a single PopDB site from PopDB.
+        @param service    PopDB service
+        @param sitename   PopDB site name
+        @param sites      List of sites sharing the PopDB site name
+        @param inventory  Inventory
+        @param date       datetime.date
+        @return [(replica, date, number of access, total cpu time)]
+        """
 
         datestr = date.strftime('%Y-%m-%d')
         result = self._popdb.make_request(service, ['sitename=' + sitename, 'tstart=' + datestr, 'tstop=' + datestr])
@@ -252,36 +504,40 @@ class CRABAccessHistory(object):
             except KeyError:
                 continue
 
-            replica = site.find_dataset_replica(dataset)
-            if replica is None:
-                continue
+            naccess = int(ds_entry['NACC'])
+            cputime = float(ds_entry['TOTCPU'])
 
-            records.append((replica, date, int(ds_entry['NACC']), float(ds_entry['TOTCPU'])))
+            for site in sites:
+                replica = site.find_dataset_replica(dataset)
+                if replica is None:
+                    continue
+
+                records.append((replica, date, naccess, cputime))
 
         return records
 
-    def _save_records(self, records):
+    def _save_records(self, records, site_id_map, dataset_id_map):
         """
-        Save the newly fetched access records.
-        @param records  {replica: {date: (number of access, total cpu time)}}
+        Save a batch of newly fetched access records.
+        @param records         [(replica, date, number of access, total cpu time)]
+        @param site_id_map     {site name: history DB id}, updated with new names
+        @param dataset_id_map  {dataset name: history DB id}, updated with new names
         """
 
-        site_names = set(r.site.name for r in records.iterkeys())
-        self._history.save_sites(site_names)
-        site_id_map = dict(self._history.db.select_many('sites', ('name', 'id'), 'name', site_names))
+        site_names = set(r[0].site.name for r in records) - site_id_map.viewkeys()
+        if len(site_names) != 0:
+            self._history.save_sites(site_names)
+            site_id_map.update(self._history.db.select_many('sites', ('name', 'id'), 'name', site_names))
 
-        dataset_names = set(r.dataset.name for r in records.iterkeys())
-        self._history.save_datasets(dataset_names)
-        dataset_id_map = dict(self._history.db.select_many('datasets', ('name', 'id'), 'name', dataset_names))
+        dataset_names = set(r[0].dataset.name for r in records) - dataset_id_map.viewkeys()
+        if len(dataset_names) != 0:
+            self._history.save_datasets(dataset_names)
+            dataset_id_map.update(self._history.db.select_many('datasets', ('name', 'id'), 'name', dataset_names))
 
         fields = ('dataset_id', 'site_id', 'date', 'access_type', 'num_accesses', 'cputime')
 
         data = []
-        for replica, entries in records.iteritems():
-            dataset_id = dataset_id_map[replica.dataset.name]
-            site_id = site_id_map[replica.site.name]
-
-            for date, (num_accesses, cputime) in entries.iteritems():
-                data.append((dataset_id, site_id, date.strftime('%Y-%m-%d'), 'local', num_accesses, cputime))
+        for replica, date, num_accesses, cputime in records:
+            data.append((dataset_id_map[replica.dataset.name], site_id_map[replica.site.name], date.strftime('%Y-%m-%d'), 'local', num_accesses, cputime))
 
         self._history.db.insert_many('dataset_accesses', fields, None, data, do_update = True)
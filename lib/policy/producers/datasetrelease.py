@@ -1,8 +1,12 @@
+import os
 import re
+import json
+import hashlib
 import collections
 import logging
 
 from dynamo.utils.interface.dbs import DBS
+from dynamo.policy.resultcache import ProducerResultCache
 
 LOG = logging.getLogger(__name__)
 
@@ -17,32 +21,103 @@ class DatasetRelease(object):
     def __init__(self, config):
         self._dbs = DBS(config.get('dbs', None))
 
-    def load(self, inventory):
-        latest_minor = collections.defaultdict(int)
+        # parsed release table is saved here with the hash of the acquisition era list
+        self._cache_path = config.get('cache_path', None)
+
+        # attrs shared with the other runs of a sequence while the acquisition era list is unchanged
+        if config.get('result_cache', None):
+            self._result_cache = ProducerResultCache(config.result_cache)
+        else:
+            self._result_cache = None
 
+    def load(self, inventory):
         results = self._dbs.make_request('acquisitioneras')
-        for result in results:
-            release = result['acquisition_era_name']
-            matches = re.match('CMSSW_([0-9]+)_([0-9]+)_([0-9]+)', release)
-            if not matches:
-                continue
 
-            cycle = int(matches.group(1))
-            major = int(matches.group(2))
-            minor = int(matches.group(3))
+        era_names = sorted(result['acquisition_era_name'] for result in results)
+        era_hash = hashlib.sha1(json.dumps(era_names)).hexdigest()
 
-            if minor > latest_minor[(cycle, major)]:
-                latest_minor[(cycle, major)] = minor
+        if self._result_cache is not None and self._result_cache.load(self, inventory, era_hash):
+            return
+
+        latest_minor = self._read_cache(era_hash)
+
+        if latest_minor is None:
+            latest_minor = self._parse_releases(era_names)
+            self._write_cache(era_hash, latest_minor)
 
         if LOG.getEffectiveLevel() == logging.DEBUG:
             LOG.debug('Latest releases:')
             for cm in sorted(latest_minor.keys()):
-                LOG.debug(cm + (latest_minor[cm],))
+                LOG.debug('CMSSW_%d_%d_%d', cm[0], cm[1], latest_minor[cm])
 
+        # evaluate once per software version
+        datasets_by_release = collections.defaultdict(list)
         for dataset in inventory.datasets.itervalues():
             release = dataset.software_version
             if release is None:
                 continue
 
-            if release[2] == latest_minor[release[:2]]:
-                dataset.attr['latest_production_release'] = True
+            datasets_by_release[release].append(dataset)
+
+        for release, datasets in datasets_by_release.iteritems():
+            # no known era for the cycle & major is treated as minor 0
+            if release[2] == latest_minor.get(release[:2], 0):
+                for dataset in datasets:
+                    dataset.attr['latest_production_release'] = True
+
+        if self._result_cache is not None:
+            self._result_cache.save(self, inventory, era_hash)
+
+    def _parse_releases(self, era_names):
+        """
+        @param era_names  List of acquisition era names
+        @return  {(cycle, major): latest minor}
+        """
+
+        latest_minor = {}
+
+        for release in era_names:
+            matches = re.match('CMSSW_([0-9]+)_([0-9]+)_([0-9]+)', release)
+            if not matches:
+                continue
+
+            cycle = int(matches.group(1))
+            major = int(matches.group(2))
+            minor = int(matches.group(3))
+
+            if minor > latest_minor.get((cycle, major), 0):
+                latest_minor[(cycle, major)] = minor
+
+        return latest_minor
+
+    def _read_cache(self, era_hash):
+        """
+        @param era_hash  Hash of the current acquisition era list
+        @return  {(cycle, major): latest minor} or None if there is no cache for the hash
+        """
+
+        if self._cache_path is None:
+            return None
+
+        try:
+            with open(self._cache_path) as source:
+                cache = json.load(source)
+        except (IOError, ValueError):
+            return None
+
+        if cache['hash'] != era_hash:
+            return None
+
+        return dict(((cycle, major), minor) for cycle, major, minor in cache['releases'])
+
+    def _write_cache(self, era_hash, latest_minor):
+        if self._cache_path is None:
+            return
+
+        cache = {'hash': era_hash, 'releases': [(cycle, major, minor) for (cycle, major), minor in latest_minor.iteritems()]}
+
+        tmp_path = self._cache_path + '.tmp'
+        with open(tmp_path, 'w') as output:
+            json.dump(cache, output)
+
+        os.rename(tmp_path, self._cache_path)
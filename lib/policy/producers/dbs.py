@@ -1,9 +1,11 @@
-import re
-import collections
+import os
+import json
+import time
 import logging
 
-from dynamo.utils.interface.webservice import RESTService
-from dynamo.dataformat import Dataset
+from dynamo.utils.interface.webservice import RESTService, POST
+from dynamo.utils.parallel import Map
+from dynamo.dataformat import Configuration, Dataset
 
 LOG = logging.getLogger(__name__)
 
@@ -19,15 +21,111 @@ class CheckAllDBS(object):
     def __init__(self, config):
         self._dbses = []
         for name, dbsconf in config.dbses.items():
-            self._dbses.append(RESTService(dbsconf))
+            self._dbses.append((name, RESTService(dbsconf)))
+
+        # number of datasets per datasetlist POST
+        self.chunk_size = config.get('chunk_size', 500)
+        self._parallel_config = config.get('parallel', Configuration())
+
+        # datasets found in DBS are not checked again for cache_lifetime hours
+        self._cache_path = config.get('cache_path', None)
+        self.cache_lifetime = config.get('cache_lifetime', 24) * 3600.
 
     def load(self, inventory):
-        for dataset in inventory.datasets.itervalues():
-            if dataset.status == Dataset.STAT_UNKNOWN:
-                for dbs in self._dbses:
-                    result = dbs.make_request('datasets', ['dataset=' + dataset.name, 'detail=true', 'dataset_access_type=*'])
-                    if len(result) != 0:
-                        break
-
-                else:
-                    dataset.attr['unknown_in_all_dbs'] = True
+        unknown_datasets = [d for d in inventory.datasets.itervalues() if d.status == Dataset.STAT_UNKNOWN]
+
+        known = self._read_cache()
+
+        to_check = set(d.name for d in unknown_datasets) - known.viewkeys()
+
+        LOG.info('%d datasets in UNKNOWN status, %d confirmed in DBS recently.', len(unknown_datasets), len(unknown_datasets) - len(to_check))
+
+        now = time.time()
+
+        for name, dbs in self._dbses:
+            if len(to_check) == 0:
+                break
+
+            found = self._find_datasets(name, dbs, sorted(to_check))
+
+            LOG.info('%d of %d datasets found in DBS %s.', len(found), len(to_check), name)
+
+            for dataset_name in found:
+                known[dataset_name] = now
+
+            to_check -= found
+
+        self._write_cache(known)
+
+        for dataset in unknown_datasets:
+            if dataset.name in to_check:
+                dataset.attr['unknown_in_all_dbs'] = True
+
+    def _find_datasets(self, name, dbs, dataset_names):
+        """
+        Query a DBS instance for many datasets with datasetlist POSTs. Chunks whose POST fails are checked
+        one dataset at a time.
+        @param name           DBS instance name
+        @param dbs            RESTService
+        @param dataset_names  List of dataset names
+        @return  Set of dataset names known to the DBS instance
+        """
+
+        def query_chunk(chunk):
+            try:
+                result = dbs.make_request('datasetlist', {'dataset': chunk, 'detail': True, 'dataset_access_type': '*'}, method = POST, format = 'json')
+            except:
+                LOG.warning('datasetlist POST to DBS %s failed for %d datasets.', name, len(chunk))
+                return chunk, None
+
+            return chunk, set(entry['dataset'] for entry in result)
+
+        def query_dataset(dataset_name):
+            result = dbs.make_request('datasets', ['dataset=' + dataset_name, 'detail=true', 'dataset_access_type=*'])
+            return dataset_name, (len(result) != 0)
+
+        # one-element tuples so that Map passes each chunk as a single argument
+        chunks = [(dataset_names[i:i + self.chunk_size],) for i in xrange(0, len(dataset_names), self.chunk_size)]
+
+        found = set()
+        failed = []
+
+        for chunk, chunk_found in Map(self._parallel_config).execute(query_chunk, chunks):
+            if chunk_found is None:
+                failed.extend(chunk)
+            else:
+                found.update(chunk_found)
+
+        if len(failed) != 0:
+            for dataset_name, exists in Map(self._parallel_config).execute(query_dataset, [(n,) for n in failed]):
+                if exists:
+                    found.add(dataset_name)
+
+        return found
+
+    def _read_cache(self):
+        """
+        @return  {dataset name: time of confirmation} without the expired entries
+        """
+
+        if self._cache_path is None:
+            return {}
+
+        try:
+            with open(self._cache_path) as source:
+                known = json.load(source)
+        except (IOError, ValueError):
+            return {}
+
+        limit = time.time() - self.cache_lifetime
+        return dict((str(name), t) for name, t in known.iteritems() if t > limit)
+
+    def _write_cache(self, known):
+        if self._cache_path is None:
+            return
+
+        tmp_path = self._cache_path + '.tmp'
+        with open(tmp_path, 'w') as output:
+            json.dump(known, output)
+
+        os.rename(tmp_path, self._cache_path)
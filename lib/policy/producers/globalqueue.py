@@ -3,13 +3,18 @@ import collections
 import logging
 import math
 import MySQLdb
+import numpy as np
 
 from dynamo.dataformat import Configuration
-from dynamo.utils.interface.htc import HTCondor
+from dynamo.utils.interface.htcquery import HTCondorJobQuery
 from dynamo.history.history import HistoryDatabase
+from dynamo.history.requestweights import DatasetRequestWeightCache
 
 GlobalQueueJob = collections.namedtuple('GlobalQueueJob', ['queue_time', 'completion_time', 'nodes_total', 'nodes_done', 'nodes_failed', 'nodes_queued'])
 
+# Stored request records in columns. dataset_index points into the datasets list.
+RequestColumns = collections.namedtuple('RequestColumns', ['datasets', 'dataset_index', 'queue_times'])
+
 LOG = logging.getLogger(__name__)
 
 class GlobalQueueRequestHistory(object):
@@ -31,41 +36,54 @@ class GlobalQueueRequestHistory(object):
             config = GlobalQueueRequestHistory._default_config
 
         self._history = HistoryDatabase(config.get('history', None))
-        self._htcondor = HTCondor(config.get('htcondor', None))
+        self._job_query = HTCondorJobQuery(config.get('htcondor', None))
 
         # Weight computation halflife constant (given in days in config)
         self.weight_halflife = config.get('weight_halflife', 4) * 3600. * 24.
 
+        # job ads are saved to the DB every save_batch_size records
+        self.save_batch_size = config.get('save_batch_size', 10000)
+
+        # incremental mode: decay cached weights and add new requests instead of reading one year of requests at each load
+        if config.get('weight_cache', None):
+            self._weight_cache = DatasetRequestWeightCache(config.weight_cache)
+        else:
+            self._weight_cache = None
+
         self.set_read_only(config.get('read_only', False))
 
     def set_read_only(self, value = True):
         self._read_only = value
 
     def load(self, inventory):
-        records = self._get_stored_records(inventory)
-        self._compute(inventory, records)
+        if self._weight_cache is None:
+            records = self._get_stored_records(inventory)
+            self._compute(inventory, records)
+        else:
+            self._load_cached(inventory)
 
     def _get_stored_records(self, inventory):
         """
-        Get the dataset request data from DB.
+        Get the dataset request data from DB. Only the queue time is needed for the weights.
         @param inventory  DynamoInventory
-        @return  {dataset: {jobid: GlobalQueueJob}}
+        @return  RequestColumns (datasets, dataset index, queue time)
         """
 
         # pick up requests that are less than 1 year old
         # old requests will be removed automatically next time the access information is saved from memory
-        sql = 'SELECT d.`name`, r.`id`, UNIX_TIMESTAMP(r.`queue_time`), UNIX_TIMESTAMP(r.`completion_time`),'
-        sql += ' r.`nodes_total`, r.`nodes_done`, r.`nodes_failed`, r.`nodes_queued` FROM `dataset_requests` AS r'
+        sql = 'SELECT d.`name`, UNIX_TIMESTAMP(r.`queue_time`) FROM `dataset_requests` AS r'
         sql += ' INNER JOIN `datasets` AS d ON d.`id` = r.`dataset_id`'
-        sql += ' WHERE r.`queue_time` > DATE_SUB(NOW(), INTERVAL 1 YEAR) ORDER BY d.`id`, r.`queue_time`'
+        sql += ' WHERE r.`queue_time` > DATE_SUB(NOW(), INTERVAL 1 YEAR) ORDER BY d.`id`'
 
-        all_requests = {}
+        datasets = []
+        dataset_index = []
+        queue_times = []
         num_records = 0
 
         # little speedup by not repeating lookups for the same dataset
         current_dataset_name = ''
         dataset_exists = True
-        for dataset_name, job_id, queue_time, completion_time, nodes_total, nodes_done, nodes_failed, nodes_queued in self._history.db.xquery(sql):
+        for dataset_name, queue_time in self._history.db.xquery(sql):
             num_records += 1
 
             if dataset_name == current_dataset_name:
@@ -82,9 +100,10 @@ class GlobalQueueRequestHistory(object):
                 else:
                     dataset_exists = True
 
-                requests = all_requests[dataset] = {}
+                datasets.append(dataset)
 
-            requests[job_id] = GlobalQueueJob(queue_time, completion_time, nodes_total, nodes_done, nodes_failed, nodes_queued)
+            dataset_index.append(len(datasets) - 1)
+            queue_times.append(queue_time)
 
         try:
             last_update = self._history.db.query('SELECT UNIX_TIMESTAMP(`dataset_requests_last_update`) FROM `popularity_last_update`', retries = 1)[0]
@@ -93,32 +112,53 @@ class GlobalQueueRequestHistory(object):
 
         LOG.info('Loaded %d dataset request data. Last update at %s UTC', num_records, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(last_update)))
 
-        return all_requests
+        return RequestColumns(datasets, np.array(dataset_index, dtype = np.int64), np.array(queue_times, dtype = np.float64))
 
-    def _compute(self, inventory, all_requests):
+    def _compute(self, inventory, requests):
         """
         Set the dataset request weight based on request list. Formula:
           w = Sum(exp(-t_i/T))
         where t_i is the time distance of the ith request from now. T is defined in the configuration.
-        @param inventory     DynamoInventory
-        @param all_requests  {dataset: {jobid: GlobalQueueJob}}
+        The exponentials and the per-dataset sums are evaluated over the whole request columns at once.
+        @param inventory  DynamoInventory
+        @param requests   RequestColumns
         """
 
         now = time.time()
         decay_constant = self.weight_halflife / math.log(2.)
 
-        for dataset in inventory.datasets.itervalues():
+        contributions = np.exp((requests.queue_times - now) / decay_constant)
+        weights = np.bincount(requests.dataset_index, weights = contributions, minlength = len(requests.datasets))
+
+        self._set_weights(inventory, requests.datasets, weights.tolist())
+
+    def _load_cached(self, inventory):
+        """
+        Set the dataset request weight from the weight cache (incremental mode).
+        @param inventory  DynamoInventory
+        """
+
+        decay_constant = self.weight_halflife / math.log(2.)
+
+        names, weights = self._weight_cache.load(self._history.db, decay_constant)
+
+        datasets = []
+        dataset_weights = []
+        for name, weight in zip(names, weights.tolist()):
             try:
-                requests = all_requests[dataset]
+                datasets.append(inventory.datasets[name])
             except KeyError:
-                dataset.attr['request_weight'] = 0.
                 continue
 
-            weight = 0.
-            for job in requests.itervalues():
-                # first element of reqdata tuple is the queue time
-                weight += math.exp((job.queue_time - now) / decay_constant)
-            
+            dataset_weights.append(weight)
+
+        self._set_weights(inventory, datasets, dataset_weights)
+
+    def _set_weights(self, inventory, datasets, weights):
+        for dataset in inventory.datasets.itervalues():
+            dataset.attr['request_weight'] = 0.
+
+        for dataset, weight in zip(datasets, weights):
             dataset.attr['request_weight'] = weight
 
     def update(self, inventory):
@@ -138,43 +178,40 @@ class GlobalQueueRequestHistory(object):
             self._read_only = True
             LOG.info('Cannot write to DB. Switching to self._read_only.')
 
-        source_records = self._get_source_records(inventory, last_update)
+        self._ingest(inventory, last_update)
 
         if not self._read_only:
-            self._save_records(source_records)
             # remove old entries
             self._history.db.query('DELETE FROM `dataset_requests` WHERE `queue_time` < DATE_SUB(NOW(), INTERVAL 1 YEAR)')
             self._history.db.query('UPDATE `popularity_last_update` SET `dataset_requests_last_update` = NOW()')
 
-    def _get_source_records(self, inventory, last_update):
+    def _ingest(self, inventory, last_update):
         """
-        Get the dataset request data from Global Queue schedd.
+        Get the dataset request data from the Global Queue schedds and save them to the DB. The job ads are
+        consumed from the schedd query stream and saved every save_batch_size records.
         @param inventory    DynamoInventory
         @param last_update  UNIX timestamp
-        @return {dataset: {jobid: GlobalQueueJob}}
         """
 
         constraint = 'TaskType=?="ROOT" && !isUndefined(DESIRED_CMSDataset) && (QDate > {last_update} || CompletionDate > {last_update})'.format(last_update = last_update)
 
         attributes = ['DESIRED_CMSDataset', 'GlobalJobId', 'QDate', 'CompletionDate', 'DAG_NodesTotal', 'DAG_NodesDone', 'DAG_NodesFailed', 'DAG_NodesQueued']
-        
-        job_ads = self._htcondor.find_jobs(constraint = constraint, attributes = attributes)
 
-        job_ads.sort(key = lambda a: a['DESIRED_CMSDataset'])
+        # history DB dataset ids are looked up once per name over all batches
+        dataset_id_map = {}
 
-        all_requests = {}
+        batch = []
+        num_ads = 0
+        num_records = 0
 
-        for ad in job_ads:
-            dataset_name = ad['DESIRED_CMSDataset']
+        for ad in self._job_query.iter_jobs(constraint = constraint, attributes = attributes):
+            num_ads += 1
 
             try:
-                dataset = inventory.datasets[dataset_name]
+                dataset = inventory.datasets[ad['DESIRED_CMSDataset']]
             except KeyError:
                 continue
 
-            if dataset not in all_requests:
-                all_requests[dataset] = {}
-
             try:
                 nodes_total = ad['DAG_NodesTotal']
                 nodes_done = ad['DAG_NodesDone']
@@ -186,45 +223,61 @@ class GlobalQueueRequestHistory(object):
                 nodes_failed = 0
                 nodes_queued = 0
 
-            all_requests[dataset][ad['GlobalJobId']] = GlobalQueueJob(
+            batch.append((dataset, ad['GlobalJobId'], GlobalQueueJob(
                 ad['QDate'],
                 ad['CompletionDate'],
                 nodes_total,
                 nodes_done,
                 nodes_failed,
                 nodes_queued
-            )
+            )))
+
+            if len(batch) >= self.save_batch_size:
+                if not self._read_only:
+                    self._save_records(batch, dataset_id_map)
+                num_records += len(batch)
+                batch = []
+
+        if len(batch) != 0:
+            if not self._read_only:
+                self._save_records(batch, dataset_id_map)
+            num_records += len(batch)
 
-        return all_requests
+        LOG.info('Fetched %d job ads, %d for datasets in the inventory.', num_ads, num_records)
 
-    def _save_records(self, records):
+    def _save_records(self, records, dataset_id_map):
         """
-        Save the newly fetched request records.
-        @param records  {dataset: {jobid: GlobalQueueJob}}
+        Save a batch of newly fetched request records.
+        @param records         [(dataset, job id, GlobalQueueJob)]
+        @param dataset_id_map  {dataset name: history DB id}, updated with new names
         """
 
-        dataset_names = [d.name for d in records.iterkeys()]
-
-        self._history.save_datasets(dataset_names)
-        dataset_id_map = dict(self._history.db.select_many('datasets', ('name', 'id'), 'name', dataset_names))
+        dataset_names = set(r[0].name for r in records) - dataset_id_map.viewkeys()
+        if len(dataset_names) != 0:
+            self._history.save_datasets(dataset_names)
+            dataset_id_map.update(self._history.db.select_many('datasets', ('name', 'id'), 'name', dataset_names))
 
         fields = ('id', 'dataset_id', 'queue_time', 'completion_time', 'nodes_total', 'nodes_done', 'nodes_failed', 'nodes_queued')
 
         data = []
-        for dataset, dataset_request_list in records.iteritems():
-            dataset_id = dataset_id_map[dataset.name]
-
-            for job_id, (queue_time, completion_time, nodes_total, nodes_done, nodes_failed, nodes_queued) in dataset_request_list.iteritems():
-                data.append((
-                    job_id,
-                    dataset_id,
-                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(queue_time)),
-                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(completion_time)) if completion_time > 0 else '0000-00-00 00:00:00',
-                    nodes_total,
-                    nodes_done,
-                    nodes_failed,
-                    nodes_queued
-                ))
+        for dataset, job_id, (queue_time, completion_time, nodes_total, nodes_done, nodes_failed, nodes_queued) in records:
+            data.append((
+                job_id,
+                dataset_id_map[dataset.name],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(queue_time)),
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(completion_time)) if completion_time > 0 else '0000-00-00 00:00:00',
+                nodes_total,
+                nodes_done,
+                nodes_failed,
+                nodes_queued
+            ))
 
-        self._history.db.insert_many('dataset_requests', fields, None, data, do_update = True)
+        if self._weight_cache is not None:
+            # requests that are already in the DB are only updated and do not change the cached weights
+            job_ids = [entry[0] for entry in data]
+            existing = set(entry[0] for entry in self._history.db.select_many('dataset_requests', ('id', 'dataset_id'), 'id', job_ids))
+            queue_times = [job.queue_time for _, job_id, job in records if job_id not in existing]
+            if len(queue_times) != 0:
+                self._weight_cache.invalidate(min(queue_times))
 
+        self._history.db.insert_many('dataset_requests', fields, None, data, do_update = True)
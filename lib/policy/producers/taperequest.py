@@ -1,8 +1,11 @@
-import re
-import collections
+import os
+import json
+import time
 import logging
 
 from dynamo.utils.interface.phedex import PhEDEx
+from dynamo.utils.parallel import Map
+from dynamo.policy.resultcache import ProducerResultCache
 from dynamo.dataformat import Block, Site
 
 LOG = logging.getLogger(__name__)
@@ -19,35 +22,110 @@ class TapeCopyRequested(object):
     def __init__(self, config):
         self._phedex = PhEDEx(config.get('phedex', None))
 
+        # per-site results are reused for cache_lifetime minutes, e.g. by the detox policies run back to back in a sequence
+        self._cache_path = config.get('cache_path', None)
+        self.cache_lifetime = config.get('cache_lifetime', 30) * 60.
+
+        # flags shared with the other runs of a sequence; the entry expires after the lifetime set in result_cache
+        if config.get('result_cache', None):
+            self._result_cache = ProducerResultCache(config.result_cache)
+        else:
+            self._result_cache = None
+
     def load(self, inventory):
-        for site in inventory.sites.itervalues():
-            if site.storage_type != Site.TYPE_MSS:
-                continue
-
-            requests = self._phedex.make_request('transferrequests', ['node=' + site.name, 'approval=pending'])
-            for request in requests:
-                for dest in request['destinations']['node']:
-                    if dest['name'] != site.name:
-                        continue
-
-                    if 'decided_by' in dest:
-                        break
-
-                    for dataset_entry in request['data']['dbs']['dataset']:
-                        try:
-                            dataset = inventory.datasets[dataset_entry['name']]
-                        except KeyError:
-                            continue
-
-                        dataset.attr['tape_copy_requested'] = True
-
-                    for block_entry in request['data']['dbs']['block']:
-                        dataset_name, block_name = Block.from_full_name(block_entry['name'])
-                        try:
-                            dataset = inventory.datasets[dataset_name]
-                        except KeyError:
-                            continue
-
-                        # just label the entire dataset
-                        dataset.attr['tape_copy_requested'] = True
- 
+        if self._result_cache is not None and self._result_cache.load(self, inventory):
+            return
+
+        sites = [site for site in inventory.sites.itervalues() if site.storage_type == Site.TYPE_MSS]
+
+        cache = self._read_cache()
+
+        requested = {} # {site name: [dataset names]}
+        arg_pool = []
+        for site in sites:
+            try:
+                requested[site.name] = cache[site.name]['datasets']
+            except KeyError:
+                arg_pool.append((site.name,))
+
+        LOG.info('Querying pending transfer requests to %d tape sites (%d cached).', len(arg_pool), len(requested))
+
+        now = time.time()
+        for site_name, dataset_names in Map().execute(self._get_requested_datasets, arg_pool):
+            requested[site_name] = dataset_names
+            cache[site_name] = {'time': now, 'datasets': dataset_names}
+
+        self._write_cache(cache)
+
+        # each dataset is looked up and flagged once
+        flagged = set()
+        for dataset_names in requested.itervalues():
+            for dataset_name in dataset_names:
+                if dataset_name in flagged:
+                    continue
+
+                flagged.add(dataset_name)
+
+                try:
+                    dataset = inventory.datasets[dataset_name]
+                except KeyError:
+                    continue
+
+                dataset.attr['tape_copy_requested'] = True
+
+        if self._result_cache is not None:
+            self._result_cache.save(self, inventory)
+
+    def _get_requested_datasets(self, site_name):
+        """
+        @param site_name  Name of a tape site
+        @return  (site name, [names of datasets with pending transfer requests to the site])
+        """
+
+        dataset_names = set()
+
+        requests = self._phedex.make_request('transferrequests', ['node=' + site_name, 'approval=pending'])
+        for request in requests:
+            for dest in request['destinations']['node']:
+                if dest['name'] != site_name:
+                    continue
+
+                if 'decided_by' in dest:
+                    break
+
+                for dataset_entry in request['data']['dbs']['dataset']:
+                    dataset_names.add(dataset_entry['name'])
+
+                for block_entry in request['data']['dbs']['block']:
+                    # just label the entire dataset
+                    dataset_name, block_name = Block.from_full_name(block_entry['name'])
+                    dataset_names.add(dataset_name)
+
+        return site_name, list(dataset_names)
+
+    def _read_cache(self):
+        """
+        @return  {site name: {'time': timestamp, 'datasets': [dataset names]}} without the expired entries
+        """
+
+        if self._cache_path is None:
+            return {}
+
+        try:
+            with open(self._cache_path) as source:
+                cache = json.load(source)
+        except (IOError, ValueError):
+            return {}
+
+        limit = time.time() - self.cache_lifetime
+        return dict((str(site_name), entry) for site_name, entry in cache.iteritems() if entry['time'] > limit)
+
+    def _write_cache(self, cache):
+        if self._cache_path is None:
+            return
+
+        tmp_path = self._cache_path + '.tmp'
+        with open(tmp_path, 'w') as output:
+            json.dump(cache, output)
+
+        os.rename(tmp_path, self._cache_path)
@@ -6,10 +6,40 @@ import re
 import time
 
 import dynamo.utils.interface.webservice as webservice
-from dynamo.dataformat import Configuration, Block, ObjectError
+from dynamo.dataformat import Configuration, Dataset, Block, ObjectError
+from dynamo.utils.parallel import Map
 
 LOG = logging.getLogger(__name__)
 
+def diff_locks(previous, current):
+    """
+    @param previous  Set of locks
+    @param current   Set of locks
+    @return  (added locks, removed locks)
+    """
+
+    return current - previous, previous - current
+
+def lock_names(locks):
+    """
+    @param locks  Iterable of (dataset or block, site or None)
+    @return  Set of (dataset or block full name, site name or None)
+    """
+
+    names = set()
+    for item, site in locks:
+        if site is None:
+            site_name = None
+        else:
+            site_name = site.name
+
+        if type(item) is Dataset:
+            names.add((item.name, site_name))
+        else:
+            names.add((item.full_name(), site_name))
+
+    return names
+
 class WebReplicaLock(object):
     """
     Dataset lock read from www or remote (Oracle) database sources.
@@ -24,6 +54,11 @@ class WebReplicaLock(object):
 
     def __init__(self, config):
         self._sources = {} # {name: (RESTService, content type, site pattern, lock of locks)}
+        self._source_options = {} # {name: (timeout, lock wait)}
+
+        # locks applied in the last load(), and the replica sites and number of blocks of the locked datasets
+        self._locks = None
+        self._dataset_states = {} # {dataset: (frozenset(sites), number of blocks)}
 
         for name, source_config in config.sources.items():
             self.add_source(name, source_config, config.auth)
@@ -44,6 +79,9 @@ class WebReplicaLock(object):
         site_pattern = config.get('sites', None)
         lock_url = config.get('lock_url', None)
 
+        # per-source timeout of the data request and maximum wait for the lock of locks (None = wait forever)
+        self._source_options[name] = (config.get('timeout', 300), config.get('lock_wait', None))
+
         if rest_config.url_base is not None:
             self._sources[name] = (webservice.RESTService(rest_config), content_type, site_pattern, lock_url)
 
@@ -53,33 +91,79 @@ class WebReplicaLock(object):
             oracle_config.pw = config.oracledb.password
             oracle_config.host = config.oracledb.host
             self._sources[name] = (webservice.OracleService(oracle_config), content_type, site_pattern, (config.oracledb.lockoflock,config.oracledb.locks))
-            
 
     def load(self, inventory):
-        for dataset in inventory.datasets.itervalues():
-            try:
-                dataset.attr.pop('locked_blocks')
-            except KeyError:
-                pass
+        locks = set(self.get_list(inventory))
+
+        if self._locks is None:
+            for dataset in inventory.datasets.itervalues():
+                try:
+                    dataset.attr.pop('locked_blocks')
+                except KeyError:
+                    pass
+
+            changed = locks
+        else:
+            added, removed = diff_locks(self._locks, locks)
+            changed = added | removed
 
-        for item, site in self.get_list(inventory):
+            LOG.info('%d locks added, %d locks removed.', len(added), len(removed))
+
+        self._locks = locks
+
+        # only the datasets with added or removed locks are updated
+        datasets = set()
+        for item, site in changed:
+            if type(item) is Dataset:
+                datasets.add(item)
+            else:
+                datasets.add(item.dataset)
+
+        dataset_locks = collections.defaultdict(list)
+        for item, site in locks:
             if type(item) is Dataset:
                 dataset = item
-                block = None
             else:
                 dataset = item.dataset
-                block = item
 
-            try:
-                locked_blocks = dataset.attr['locked_blocks']
-            except KeyError:
-                locked_blocks = dataset.attr['locked_blocks'] = {}
+            dataset_locks[dataset].append((item, site))
+
+        # locked_blocks also depends on the replica sites (locks without a site) and on the block list
+        # (all blocks locked = dataset-level lock); datasets whose replicas or blocks changed are updated too
+        dataset_states = {}
+        for dataset in dataset_locks.iterkeys():
+            state = dataset_states[dataset] = (frozenset(r.site for r in dataset.replicas), len(dataset.blocks))
+            if self._dataset_states.get(dataset) != state:
+                datasets.add(dataset)
+
+        self._dataset_states = dataset_states
+
+        for dataset in datasets:
+            self._set_locked_blocks(dataset, dataset_locks.get(dataset, []))
+
+    def _set_locked_blocks(self, dataset, locks):
+        """
+        @param dataset  Dataset
+        @param locks    List of (dataset or block, site or None) for the dataset
+        """
+
+        if len(locks) == 0:
+            dataset.attr.pop('locked_blocks', None)
+            return
+
+        locked_blocks = dataset.attr['locked_blocks'] = {}
+
+        for item, site in locks:
+            if type(item) is Dataset:
+                block = None
+            else:
+                block = item
 
             if site is None:
                 sites = [r.site for r in dataset.replicas]
             else:
                 sites = [site]
-                    
+
             for st in sites:
                 if block is None:
                     locked_blocks[st] = None
@@ -89,159 +173,178 @@ class WebReplicaLock(object):
                     else:
                         locked_blocks[st].add(block)
                 else:
-                    locked_blocks[st] = set(block)
+                    locked_blocks[st] = set([block])
 
-        for dataset in inventory.dataests.itervalues():
-            try:
-                locked_blocks = dataset.attr['locked_blocks']
-            except KeyError:
+        for site, blocks in locked_blocks.items():
+            if blocks is None:
                 continue
 
-            for site, blocks in locked_blocks.items():
-                if blocks is None:
-                    continue
-
-                # if all blocks are locked, set to None (dataset-level lock)
-                if blocks == dataset.blocks:
-                    locked_blocks[site] = None
+            # if all blocks are locked, set to None (dataset-level lock)
+            if blocks == dataset.blocks:
+                locked_blocks[site] = None
 
     def get_list(self, inventory):
+        """
+        Fetch the locks from all sources concurrently.
+        @param inventory  DynamoInventory
+        @return  [(dataset or block, site or None)]
+        """
+
         all_locks = [] # [(item, site)]
 
-        for source, content_type, site_pattern, lock_url in self._sources.itervalues():        
-            if lock_url is not None and isinstance(lock_url, basestring):
-                # check that the lock files themselves are not locked
-                while True:
-                    # Hacky but this is temporary any way
-                    opener = urllib2.build_opener(webservice.HTTPSCertKeyHandler(Configuration()))
-                    opener.addheaders.append(('Accept', 'application/json'))
-                    request = urllib2.Request(lock_url)
-                    try:
-                        opener.open(request)
-                    except urllib2.HTTPError as err:
-                        if err.code == 404:
-                            # file not found -> no lock
-                            break
-                        else:
-                            raise
-        
-                    LOG.info('Lock files are being produced. Waiting 60 seconds.')
-                    time.sleep(60)
-            elif not isinstance(lock_url, basestring):
-                # lock_url is a tuple of Oracle db queries (a,b): a - checking for lock of locks, b - locks themselves
-                # source is automatically an OracleService
+        arg_pool = [(name, inventory) for name in self._sources.iterkeys()]
+
+        for locks in Map().execute(self._get_source_list, arg_pool):
+            all_locks.extend(locks)
+
+        return all_locks
+
+    def _get_source_list(self, name, inventory):
+        source, content_type, site_pattern, lock_url = self._sources[name]
+        timeout, lock_wait = self._source_options[name]
+
+        all_locks = [] # [(item, site)]
+
+        if lock_wait is None:
+            deadline = None
+        else:
+            deadline = time.time() + lock_wait
+
+        if lock_url is not None and isinstance(lock_url, basestring):
+            # check that the lock files themselves are not locked
+            while True:
+                # Hacky but this is temporary any way
+                opener = urllib2.build_opener(webservice.HTTPSCertKeyHandler(Configuration()))
+                opener.addheaders.append(('Accept', 'application/json'))
+                request = urllib2.Request(lock_url)
                 try:
-                    locked = True
-                    while locked:
-                        locked = False
-                        locks = source.make_request(lock_url[0].replace('`','"'))
-                        for lock in locks:
-                            if lock == 1:
-                                locked = True
-                                break
-                        if not locked:
-                            break
-
-                        LOG.info('Locks are being produced. Waiting 60 seconds.')
-                        time.sleep(60)
+                    opener.open(request, timeout = timeout)
+                except urllib2.HTTPError as err:
+                    if err.code == 404:
+                        # file not found -> no lock
+                        break
+                    else:
+                        raise
+
+                if deadline is not None and time.time() > deadline:
+                    raise RuntimeError('Lock files of %s are still being produced after %d seconds.' % (name, lock_wait))
+
+                LOG.info('Lock files are being produced. Waiting 60 seconds.')
+                time.sleep(60)
+        elif lock_url is not None:
+            # lock_url is a tuple of Oracle db queries (a,b): a - checking for lock of locks, b - locks themselves
+            # source is automatically an OracleService
+            while True:
+                try:
+                    locks = source.make_request(lock_url[0].replace('`','"'))
                 except:
-                    pass
-                        
-            if site_pattern is None:
-                site_re = None
-            else:
-                site_re = re.compile(fnmatch.translate(site_pattern))
+                    # lock of locks cannot be checked
+                    break
 
-            LOG.info('Retrieving lock information from %s', source)
+                if not any(lock == 1 for lock in locks):
+                    break
 
-            try:
-                data = source.make_request()
-            except TypeError:
-                # OracleService expects a query text
-                data = source.make_request(lock_url[1].replace('`','"'))
+                if deadline is not None and time.time() > deadline:
+                    raise RuntimeError('Locks of %s are still being produced after %d seconds.' % (name, lock_wait))
 
-            if content_type == WebReplicaLock.LIST_OF_DATASETS:
-                # simple list of datasets
-                for dataset_name in data:
-                    if dataset_name is None:
-                        LOG.debug('Dataset name None found in %s', source)
-                        continue
+                LOG.info('Locks are being produced. Waiting 60 seconds.')
+                time.sleep(60)
 
-                    try:
-                        dataset = inventory.datasets[dataset_name]
-                    except KeyError:
-                        LOG.debug('Unknown dataset %s in %s', dataset_name, source)
-                        continue
+        if site_pattern is None:
+            site_re = None
+        else:
+            site_re = re.compile(fnmatch.translate(site_pattern))
 
-                    if site_re is not None:
-                        for replica in dataset.replicas:
-                            if not site_re.match(replica.site.name):
-                                continue
-                            
-                            all_locks.append((dataset, replica.site))
-                    else:
-                        all_locks.append((dataset, None))
+        LOG.info('Retrieving lock information from %s', name)
+
+        if isinstance(source, webservice.OracleService):
+            # OracleService expects a query text
+            data = source.make_request(lock_url[1].replace('`','"'))
+        else:
+            data = source.make_request(timeout = timeout)
+
+        if content_type == WebReplicaLock.LIST_OF_DATASETS:
+            # simple list of datasets
+            for dataset_name in data:
+                if dataset_name is None:
+                    LOG.debug('Dataset name None found in %s', name)
+                    continue
+
+                try:
+                    dataset = inventory.datasets[dataset_name]
+                except KeyError:
+                    LOG.debug('Unknown dataset %s in %s', dataset_name, name)
+                    continue
+
+                if site_re is not None:
+                    for replica in dataset.replicas:
+                        if not site_re.match(replica.site.name):
+                            continue
+
+                        all_locks.append((dataset, replica.site))
+                else:
+                    all_locks.append((dataset, None))
 
-            elif content_type == WebReplicaLock.CMSWEB_LIST_OF_DATASETS:
-                # data['result'] -> simple list of datasets
-                for dataset_name in data['result']:
-                    if dataset_name is None:
-                        LOG.debug('Dataset name None found in %s', source.url_base)
+        elif content_type == WebReplicaLock.CMSWEB_LIST_OF_DATASETS:
+            # data['result'] -> simple list of datasets
+            for dataset_name in data['result']:
+                if dataset_name is None:
+                    LOG.debug('Dataset name None found in %s', name)
+                    continue
+
+                try:
+                    dataset = inventory.datasets[dataset_name]
+                except KeyError:
+                    LOG.debug('Unknown dataset %s in %s', dataset_name, name)
+                    continue
+
+                if site_re is not None:
+                    for replica in dataset.replicas:
+                        if not site_re.match(replica.site.name):
+                            continue
+
+                        all_locks.append((dataset, replica.site))
+                else:
+                    all_locks.append((dataset, None))
+
+        elif content_type == WebReplicaLock.SITE_TO_DATASETS:
+            # data = {site: {dataset: info}}
+            for site_name, objects in data.items():
+                try:
+                    site = inventory.sites[site_name]
+                except KeyError:
+                    LOG.debug('Unknown site %s in %s', site_name, name)
+                    continue
+
+                for object_name, info in objects.items():
+                    if not info['lock']:
+                        LOG.debug('Object %s is not locked at %s', object_name, site_name)
                         continue
 
                     try:
-                        dataset = inventory.datasets[dataset_name]
-                    except KeyError:
-                        LOG.debug('Unknown dataset %s in %s', dataset_name, source.url_base)
-                        continue
+                        dataset_name, block_name = Block.from_full_name(object_name)
+                    except ObjectError:
+                        dataset_name, block_name = object_name, None
 
-                    if site_re is not None:
-                        for replica in dataset.replicas:
-                            if not site_re.match(replica.site.name):
-                                continue
-    
-                            all_locks.append((dataset, replica.site))
-                    else:
-                        all_locks.append((dataset, None))
-                
-            elif content_type == WebReplicaLock.SITE_TO_DATASETS:
-                # data = {site: {dataset: info}}
-                for site_name, objects in data.items():
                     try:
-                        site = inventory.sites[site_name]
+                        dataset = inventory.datasets[dataset_name]
                     except KeyError:
-                        LOG.debug('Unknown site %s in %s', site_name, source.url_base)
+                        LOG.debug('Unknown dataset %s in %s', dataset_name, name)
                         continue
 
-                    for object_name, info in objects.items():
-                        if not info['lock']:
-                            LOG.debug('Object %s is not locked at %s', object_name, site_name)
-                            continue
-
-                        try:
-                            dataset_name, block_name = Block.from_full_name(object_name)
-                        except ObjectError:
-                            dataset_name, block_name = object_name, None
-
-                        try:
-                            dataset = inventory.datasets[dataset_name]
-                        except KeyError:
-                            LOG.debug('Unknown dataset %s in %s', dataset_name, source.url_base)
-                            continue
+                    replica = site.find_dataset_replica(dataset)
+                    if replica is None:
+                        LOG.debug('Replica of %s is not at %s in %s', dataset_name, site_name, name)
+                        continue
 
-                        replica = site.find_dataset_replica(dataset)
-                        if replica is None:
-                            LOG.debug('Replica of %s is not at %s in %s', dataset_name, site_name, source.url_base)
+                    if block_name is None:
+                        all_locks.append((dataset, site))
+                    else:
+                        block_replica = replica.find_block_replica(block_name)
+                        if block_replica is None:
+                            LOG.debug('Unknown block %s in %s', object_name, name)
                             continue
 
-                        if block_name is None:
-                            all_locks.append((dataset, site))
-                        else:
-                            block_replica = replica.find_block_replica(block_name)
-                            if block_replica is None:
-                                LOG.debug('Unknown block %s in %s', object_name, source.url_base)
-                                continue
-
-                            all_locks.append((block_replica.block, site))
+                        all_locks.append((block_replica.block, site))
 
         return all_locks
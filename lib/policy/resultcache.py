@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+
+from dynamo.dataformat import Configuration
+
+LOG = logging.getLogger(__name__)
+
+class ProducerResultCache(object):
+    """
+    On-disk cache of the attrs set by policy producers, shared by the detox and dealer runs of a sequence.
+    Each producer has a directory under the cache path with one column per attr:
+      dataset_id.npy  dataset ids
+      <attr>.npy      attr values aligned with dataset_id.npy (memory-mapped on read)
+      meta.json       {"time": timestamp, "stamp": input stamp, "num_datasets": N, "attrs": [names]}
+    An entry is valid for the configured lifetime if the input stamp given by the producer and the number of
+    datasets in the inventory have not changed. Only scalar attrs (bool, int, float) can be cached.
+    """
+
+    def __init__(self, config):
+        config = Configuration(config)
+
+        self.path = config.path
+        self.lifetime = config.get('lifetime', 3600)
+
+    def load(self, producer, inventory, stamp = ''):
+        """
+        Set the attrs of the producer from the cache.
+        @param producer   Producer instance
+        @param inventory  DynamoInventory
+        @param stamp      String identifying the inputs of the producer
+        @return  True if the attrs were set
+        """
+
+        name = type(producer).__name__
+        directory = '%s/%s' % (self.path, name)
+
+        try:
+            with open(directory + '/meta.json') as source:
+                meta = json.load(source)
+        except (IOError, ValueError):
+            LOG.info('Result cache miss for %s: no entry.', name)
+            return False
+
+        age = time.time() - meta['time']
+        if age > self.lifetime:
+            LOG.info('Result cache miss for %s: entry is %d seconds old.', name, age)
+            return False
+
+        if meta['stamp'] != stamp:
+            LOG.info('Result cache miss for %s: inputs changed.', name)
+            return False
+
+        if meta['num_datasets'] != len(inventory.datasets):
+            LOG.info('Result cache miss for %s: number of datasets changed.', name)
+            return False
+
+        try:
+            dataset_ids = np.load(directory + '/dataset_id.npy', mmap_mode = 'r').tolist()
+            columns = [(str(attr), np.load('%s/%s.npy' % (directory, attr), mmap_mode = 'r').tolist()) for attr in meta['attrs']]
+        except (IOError, ValueError):
+            LOG.info('Result cache miss for %s: cannot read the entry.', name)
+            return False
+
+        id_map = dict((dataset.id, dataset) for dataset in inventory.datasets.itervalues())
+
+        try:
+            datasets = [id_map[dataset_id] for dataset_id in dataset_ids]
+        except KeyError:
+            LOG.info('Result cache miss for %s: unknown dataset.', name)
+            return False
+
+        for attr, values in columns:
+            for dataset, value in zip(datasets, values):
+                dataset.attr[attr] = value
+
+        LOG.info('Result cache hit for %s: %d datasets, entry is %d seconds old.', name, len(datasets), age)
+
+        return True
+
+    def save(self, producer, inventory, stamp = ''):
+        """
+        Save the attrs set by the producer. Datasets with none of the attrs are not saved.
+        @param producer   Producer instance
+        @param inventory  DynamoInventory
+        @param stamp      String identifying the inputs of the producer
+        """
+
+        name = type(producer).__name__
+        directory = '%s/%s' % (self.path, name)
+
+        dataset_ids = []
+        columns = dict((attr, []) for attr in producer.produces)
+
+        for dataset in inventory.datasets.itervalues():
+            attrs = dataset.attr
+            present = [attr for attr in producer.produces if attr in attrs]
+            if len(present) == 0:
+                continue
+
+            if len(present) != len(producer.produces) or dataset.id == 0:
+                LOG.info('Not caching the result of %s: dataset %s cannot be stored.', name, dataset.name)
+                return
+
+            dataset_ids.append(dataset.id)
+            for attr in producer.produces:
+                columns[attr].append(attrs[attr])
+
+        arrays = {}
+        for attr, values in columns.iteritems():
+            array = np.array(values)
+            if array.dtype == object:
+                LOG.info('Not caching the result of %s: attr %s is not a scalar.', name, attr)
+                return
+
+            arrays[attr] = array
+
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+        # meta.json is removed first and written last; it validates the columns
+        try:
+            os.unlink(directory + '/meta.json')
+        except OSError:
+            pass
+
+        np.save(directory + '/dataset_id.tmp.npy', np.array(dataset_ids, dtype = np.int64))
+        os.rename(directory + '/dataset_id.tmp.npy', directory + '/dataset_id.npy')
+
+        for attr, array in arrays.iteritems():
+            np.save('%s/%s.tmp.npy' % (directory, attr), array)
+            os.rename('%s/%s.tmp.npy' % (directory, attr), '%s/%s.npy' % (directory, attr))
+
+        meta = {'time': time.time(), 'stamp': stamp, 'num_datasets': len(inventory.datasets), 'attrs': producer.produces}
+
+        with open(directory + '/meta.tmp', 'w') as output:
+            json.dump(meta, output)
+        os.rename(directory + '/meta.tmp', directory + '/meta.json')
+
+        LOG.info('Saved the result of %s for %d datasets.', name, len(dataset_ids))
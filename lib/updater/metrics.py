@@ -0,0 +1,137 @@
+import time
+import json
+import bisect
+import logging
+import threading
+import contextlib
+
+LOG = logging.getLogger(__name__)
+
+class UpdaterMetrics(object):
+    """
+    Per-run instrumentation of the updater: wall-clock time of each phase, generic counters,
+    and call counts, latency histograms and received entries per remote endpoint.
+    """
+
+    # Upper edges (seconds) of the latency histogram bins. The last bin is open-ended.
+    latency_bins = [0.1, 0.3, 1., 3., 10., 30., 100., 300.]
+
+    def __init__(self):
+        self.start_time = time.time()
+
+        self.phases = {} # {phase: seconds}
+        self.counters = {} # {name: count}
+        self.calls = {} # {endpoint: {'calls': n, 'errors': n, 'entries': n, 'latency': [counts per bin]}}
+
+        self._open_phases = {} # {phase: start time}
+
+        # remote calls are made from parallel threads
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def begin(self, name):
+        with self._lock:
+            self._open_phases[name] = time.time()
+
+    def end(self, name):
+        with self._lock:
+            duration = time.time() - self._open_phases.pop(name)
+
+        self.add_phase(name, duration)
+        LOG.info('Phase %s took %.1f seconds.', name, duration)
+
+    def add_phase(self, name, duration):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.) + duration
+
+    def count(self, name, num = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def record_call(self, endpoint, latency, num_entries, error = False):
+        with self._lock:
+            try:
+                stat = self.calls[endpoint]
+            except KeyError:
+                stat = self.calls[endpoint] = {'calls': 0, 'errors': 0, 'entries': 0, 'latency': [0] * (len(self.latency_bins) + 1)}
+
+            stat['calls'] += 1
+            if error:
+                stat['errors'] += 1
+            stat['entries'] += num_entries
+            stat['latency'][bisect.bisect_left(self.latency_bins, latency)] += 1
+
+    def instrument(self, service, name):
+        """
+        Wrap make_request of a RESTService instance so that every call is recorded as endpoint <name>/<resource>.
+        The REST interface returns decoded JSON, so the received volume is counted in top-level entries.
+        @param service  RESTService instance
+        @param name     Service label (e.g. phedex, dbs)
+        """
+
+        make_request = service.make_request
+
+        def instrumented(resource = '', *args, **kwd):
+            return self._timed_call(name, resource, make_request, (resource,) + args, kwd)
+
+        service.make_request = instrumented
+
+    def instrument_class(self, cls, name):
+        """
+        Wrap make_request of a RESTService subclass so that calls from all of its instances are recorded,
+        including the instances created per request chunk by the operation interfaces. Instances of the class
+        must not be instrumented individually in addition.
+        @param cls   RESTService subclass
+        @param name  Service label (e.g. phedex)
+        """
+
+        make_request = cls.make_request
+
+        def instrumented(service, resource = '', *args, **kwd):
+            return self._timed_call(name, resource, make_request, (service, resource) + args, kwd)
+
+        cls.make_request = instrumented
+
+    def _timed_call(self, name, resource, make_request, args, kwd):
+        endpoint = '%s/%s' % (name, resource)
+        start = time.time()
+        try:
+            result = make_request(*args, **kwd)
+        except:
+            self.record_call(endpoint, time.time() - start, 0, error = True)
+            raise
+
+        try:
+            num_entries = len(result)
+        except TypeError:
+            num_entries = 0
+
+        self.record_call(endpoint, time.time() - start, num_entries)
+
+        return result
+
+    def to_json(self):
+        record = {
+            'start': self.start_time,
+            'duration': time.time() - self.start_time,
+            'phases': self.phases,
+            'counters': self.counters,
+            'calls': self.calls,
+            'latency_bins': self.latency_bins
+        }
+
+        return json.dumps(record)
+
+    def log_summary(self):
+        for phase, duration in sorted(self.phases.items(), key = lambda x: -x[1]):
+            LOG.info('Phase %s: %.1f s', phase, duration)
+
+        for endpoint, stat in sorted(self.calls.items()):
+            LOG.info('Endpoint %s: %d calls (%d errors), %d entries', endpoint, stat['calls'], stat['errors'], stat['entries'])
@@ -0,0 +1,314 @@
+import time
+import logging
+import contextlib
+
+from dynamo.dataformat import DatasetReplica, BlockReplica, Group
+from dynamo.fileop.rlfsm import RLFSM
+
+LOG = logging.getLogger(__name__)
+
+def file_key(lfile):
+    """
+    Key of a file in block replica file_ids: the id, or the LFN for files not yet in the inventory DB (id == 0).
+    """
+
+    return lfile.lfn if lfile.id == 0 else lfile.id
+
+class RLFSMReconciler(object):
+    """
+    Reconcile RLFSM file (de)subscriptions with the inventory and the in-house reservations.
+    File lists of blocks are indexed once per run, and (de)subscribed file ids are kept as sets
+    per (block, site), so that each phase is a set comparison instead of a loop over block files.
+    """
+
+    def __init__(self, inventory):
+        self._inventory = inventory
+
+        self._file_index = {} # {block: {file key: file}}, file key is the id or LFN if id == 0
+        self._file_ids = {} # {block: frozenset(file keys)}
+
+        self.done_subscriptions = {} # {(block, site): [subscription]}
+        self.done_desubscriptions = {} # {(block, site): [desubscription]}
+        self.subscribed_files = {} # {(block, site): set(file keys)}
+        self.desubscribed_files = {} # {(block, site): set(file keys)}
+
+        # (de)subscriptions ready to be reported to PhEDEx
+        self.completed_subscriptions = {} # {(block, site): [subscription ids]}
+        self.completed_desubscriptions = {} # {(block, site): [desubscription ids]}
+
+        self.timings = [] # [(phase, seconds)]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.time() - start))
+
+    def log_timings(self):
+        for name, duration in self.timings:
+            LOG.info('RLFSM reconciliation phase %s: %.1f seconds', name, duration)
+
+    def file_index(self, block):
+        try:
+            return self._file_index[block]
+        except KeyError:
+            pass
+
+        index = self._file_index[block] = dict((file_key(f), f) for f in block.files)
+        return index
+
+    def file_ids(self, block):
+        try:
+            return self._file_ids[block]
+        except KeyError:
+            pass
+
+        ids = self._file_ids[block] = frozenset(file_key(f) for f in block.files)
+        return ids
+
+    def collect(self, subscriptions):
+        """
+        Sort the RLFSM subscriptions by (block, site).
+        @param subscriptions  List of RLFSM.Subscription and RLFSM.Desubscription
+        """
+
+        for sub in subscriptions:
+            if type(sub) is RLFSM.Subscription:
+                key = (sub.file.block, sub.destination)
+                done = self.done_subscriptions
+                files = self.subscribed_files
+            else:
+                key = (sub.file.block, sub.site)
+                done = self.done_desubscriptions
+                files = self.desubscribed_files
+
+            if sub.status == 'done':
+                try:
+                    done[key].append(sub)
+                except KeyError:
+                    done[key] = [sub]
+
+            try:
+                files[key].add(file_key(sub.file))
+            except KeyError:
+                files[key] = set([file_key(sub.file)])
+
+    def find_completed(self):
+        """
+        Fill completed_subscriptions and completed_desubscriptions. Block replicas with partially
+        completed subscriptions get their file_ids updated.
+        """
+
+        for key, subs in self.done_subscriptions.iteritems():
+            block, site = key
+            replica = block.find_replica(site)
+
+            # replica must exist (guaranteed by RLFSM)
+            if replica.file_ids is not None:
+                file_ids = set(file_key(sub.file) for sub in subs)
+                file_ids.update(replica.file_ids)
+
+                if file_ids != self.file_index(block).viewkeys():
+                    # block replica is not complete
+                    replica.file_ids = tuple(file_ids)
+                    self._inventory.register_update(replica)
+                    continue
+
+            self.completed_subscriptions[key] = [sub.id for sub in subs]
+
+        for key, subs in self.done_desubscriptions.iteritems():
+            block, site = key
+            replica = block.find_replica(site)
+
+            if replica.file_ids is None:
+                file_ids = self.file_ids(block)
+            else:
+                file_ids = replica.file_ids
+
+            if set(file_key(sub.file) for sub in subs).issuperset(file_ids):
+                self.completed_desubscriptions[key] = [sub.id for sub in subs]
+
+    def reconcile_transfers(self, transfer_reservations):
+        """
+        @param transfer_reservations  {dataset_replica: (set(blocks), group, reservation id, operation id)}
+        @return (done subscription ids, done reservation ids, {operation id: [dataset replica clone]}, {(block, site): [missing file]})
+        """
+
+        done_subscription_ids = []
+        done_reservation_ids = []
+        copy_replica_list = {}
+        missing_files = {}
+
+        for dataset_replica, (blocks, group, rid, opid) in transfer_reservations.iteritems():
+            dataset = dataset_replica.dataset
+            site = dataset_replica.site
+
+            # Remove the list of files from done_subscriptions -> remaining files in the list are non-reserved and should be used to simply update the inventory
+            for block in blocks:
+                self.done_subscriptions.pop((block, site), None)
+
+            dataset_done_ids = []
+            for block in blocks:
+                try:
+                    dataset_done_ids.extend(self.completed_subscriptions[(block, site)])
+                except KeyError:
+                    break
+
+            else:
+                # All blocks completed
+                done_subscription_ids.extend(dataset_done_ids)
+                done_reservation_ids.append(rid)
+
+                replicas = copy_replica_list.setdefault(opid, [])
+
+                try:
+                    replica = next(r for r in replicas if r.dataset is dataset)
+                except StopIteration:
+                    replica = DatasetReplica(dataset, site, growing = False)
+                    replicas.append(replica)
+
+                # blockreplicas below are created with size = 0 because PhEDEx must ultimately confirm the replica and report back
+
+                if blocks == dataset.blocks:
+                    # dataset replica reserved
+                    replica.growing = True
+                    replica.group = group
+
+                elif replica.growing:
+                    continue
+
+                for block in blocks:
+                    replica.block_replicas.add(BlockReplica(block, site, group, size = 0))
+
+                continue
+
+            # Reservation is not complete - check that we have all necessary file subscriptions to complete this reservation eventually
+            for block in blocks:
+                replica = block.find_replica(site) # replica must exist
+                if replica.file_ids is None:
+                    # no missing file
+                    continue
+
+                index = self.file_index(block)
+                missing_keys = index.viewkeys() - set(replica.file_ids)
+                missing_keys -= self.subscribed_files.get((block, site), set())
+
+                if len(missing_keys) != 0:
+                    missing_files[(block, site)] = [index[k] for k in missing_keys]
+
+        return done_subscription_ids, done_reservation_ids, copy_replica_list, missing_files
+
+    def reconcile_deletions(self, deletion_reservations):
+        """
+        @param deletion_reservations  {dataset_replica: (set(blocks), reservation id, operation id)}
+        @return (done desubscription ids, done reservation ids, {operation id: {dataset replica: [block replicas] or None}}, {(block, site): [remaining file]})
+        """
+
+        done_subscription_ids = []
+        done_reservation_ids = []
+        deletion_replica_list = {}
+        remaining_files = {}
+
+        for dataset_replica, (blocks, rid, opid) in deletion_reservations.iteritems():
+            dataset = dataset_replica.dataset
+            site = dataset_replica.site
+
+            for block in blocks:
+                self.done_desubscriptions.pop((block, site), None)
+
+            dataset_done_ids = []
+            for block in blocks:
+                replica = block.find_replica(site)
+                if replica is None or (replica.file_ids is not None and len(replica.file_ids) == 0):
+                    continue
+
+                try:
+                    dataset_done_ids.extend(self.completed_desubscriptions[(block, site)])
+                except KeyError:
+                    break
+
+            else:
+                # All blocks completed
+                done_subscription_ids.extend(dataset_done_ids)
+                done_reservation_ids.append(rid)
+
+                replicas = deletion_replica_list.setdefault(opid, {})
+
+                if blocks == dataset.blocks:
+                    replicas[dataset_replica] = None
+                elif dataset_replica not in replicas:
+                    replicas[dataset_replica] = [BlockReplica(block, site, Group.null_group) for block in blocks]
+                elif replicas[dataset_replica] is not None:
+                    replicas[dataset_replica].extend(BlockReplica(block, site, Group.null_group) for block in blocks)
+
+                continue
+
+            # Check that we have all necessary file desubscriptions to complete this reservation eventually
+            for block in blocks:
+                replica = block.find_replica(site) # replica must exist
+                if replica.file_ids is None:
+                    existing_files = block.files
+                elif len(replica.file_ids) == 0:
+                    continue
+                else:
+                    index = self.file_index(block)
+                    existing_files = [index[k] for k in index.viewkeys() & set(replica.file_ids)]
+
+                desubscribed_keys = self.desubscribed_files.get((block, site), set())
+                files = [f for f in existing_files if file_key(f) not in desubscribed_keys]
+
+                if len(files) != 0:
+                    remaining_files[(block, site)] = files
+
+        return done_subscription_ids, done_reservation_ids, deletion_replica_list, remaining_files
+
+    def apply_unreserved(self):
+        """
+        Update the inventory from the (de)subscriptions not covered by any reservation.
+        @return  List of (de)subscription ids to close
+        """
+
+        done_subscription_ids = []
+
+        for (block, site), subs in self.done_subscriptions.iteritems():
+            replica = block.find_replica(site)
+
+            done_subscription_ids.extend(sub.id for sub in subs)
+
+            if replica.file_ids is None:
+                continue
+
+            file_ids = set(replica.file_ids)
+            file_ids.update(file_key(sub.file) for sub in subs)
+
+            if file_ids == self.file_index(block).viewkeys():
+                replica.size = block.size
+                replica.file_ids = None
+            else:
+                replica.size += sum(sub.file.size for sub in subs)
+                replica.file_ids = tuple(file_ids)
+
+            self._inventory.register_update(replica)
+
+        for (block, site), subs in self.done_desubscriptions.iteritems():
+            replica = block.find_replica(site)
+
+            done_subscription_ids.extend(sub.id for sub in subs)
+
+            if replica.file_ids is None:
+                file_ids = set(self.file_index(block).iterkeys())
+            else:
+                file_ids = set(replica.file_ids)
+
+            file_ids -= set(file_key(sub.file) for sub in subs)
+
+            if len(file_ids) == 0:
+                self._inventory.delete(replica)
+            else:
+                replica.size -= sum(sub.file.size for sub in subs)
+                replica.file_ids = tuple(file_ids)
+                self._inventory.register_update(replica)
+
+        return done_subscription_ids
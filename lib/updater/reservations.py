@@ -0,0 +1,181 @@
+import collections
+import logging
+
+from dynamo.dataformat import Block, ObjectError
+from dynamo.utils.parallel import Map
+
+LOG = logging.getLogger(__name__)
+
+class ReservationIndex(object):
+    """
+    In-memory index of the in-house transfer and deletion reservations (phedex_transfer_reservations
+    and phedex_deletion_reservations tables), keyed by dataset replica, dataset, and (block, site).
+    Reservation rows to be removed from the DB are collected and deleted in bulk by flush().
+    """
+
+    # number of items passed to one PhEDEx subscriptions call
+    query_chunk_size = 35
+
+    def __init__(self, mysql, phedex = None, read_only = False):
+        self._mysql = mysql
+        self._phedex = phedex
+        self._read_only = read_only
+
+        self.transfers = {} # {dataset_replica: (set(blocks), group, reservation id, operation id)}
+        self.deletions = {} # {dataset_replica: (set(blocks), reservation id, operation id)}
+
+        self._transfer_replicas = collections.defaultdict(set) # {dataset: set(dataset_replica)}
+        self._deletion_replicas = collections.defaultdict(set) # {dataset: set(dataset_replica)}
+        self._transfer_ids = collections.defaultdict(list) # {item name: [reservation id]}
+        self._deletion_ids = collections.defaultdict(list) # {item name: [reservation id]}
+        self._reserved_transfers = {} # {(block, site): dataset_replica}
+        self._reserved_deletions = {} # {(block, site): dataset_replica}
+
+        self._discarded_transfer_ids = set()
+        self._discarded_deletion_ids = set()
+
+    def set_read_only(self, value = True):
+        self._read_only = value
+
+    def get_transfer_entries(self):
+        """
+        @return  [(id, operation_id, item, site, group)]
+        """
+
+        entries = self._mysql.query('SELECT `id`, `operation_id`, `item`, `site`, `group` FROM `phedex_transfer_reservations`')
+        for rid, opid, item_name, site_name, group_name in entries:
+            self._transfer_ids[item_name].append(rid)
+
+        return entries
+
+    def get_deletion_entries(self):
+        """
+        @return  [(id, operation_id, item, site)]
+        """
+
+        entries = self._mysql.query('SELECT `id`, `operation_id`, `item`, `site` FROM `phedex_deletion_reservations`')
+        for rid, opid, item_name, site_name in entries:
+            self._deletion_ids[item_name].append(rid)
+
+        return entries
+
+    def find_subscriptions(self, transfer_entries):
+        """
+        Check PhEDEx for subscriptions that already exist for the reserved items. Items are grouped by
+        (site, group, level) and queried in chunks instead of making one call per reservation.
+        @param transfer_entries  [(id, operation_id, item, site, group)]
+        @return  set([(item name, site name)])
+        """
+
+        items_by_query = collections.defaultdict(list) # {(site, group, level): [item name]}
+        for rid, opid, item_name, site_name, group_name in transfer_entries:
+            try:
+                Block.from_full_name(item_name)
+            except ObjectError:
+                level = 'dataset'
+            else:
+                level = 'block'
+
+            items_by_query[(site_name, group_name, level)].append(item_name)
+
+        arg_pool = []
+        for (site_name, group_name, level), item_names in items_by_query.iteritems():
+            for pos in xrange(0, len(item_names), self.query_chunk_size):
+                arg_pool.append((site_name, group_name, level, item_names[pos:pos + self.query_chunk_size]))
+
+        existing = set()
+        for results in Map().execute(self._find_chunk_subscriptions, arg_pool):
+            existing.update(results)
+
+        return existing
+
+    def _find_chunk_subscriptions(self, site_name, group_name, level, item_names):
+        options = ['node=' + site_name, 'group=' + group_name]
+        options.extend('%s=%s' % (level, name) for name in item_names)
+
+        dataset_entries = self._phedex.make_request('subscriptions', options)
+
+        subscribed = set()
+        for dataset_entry in dataset_entries:
+            if level == 'dataset':
+                subscribed.add(dataset_entry['name'])
+            elif 'block' in dataset_entry:
+                subscribed.update(b['name'] for b in dataset_entry['block'])
+            else:
+                # dataset-level subscription overrides the block-level ones
+                prefix = dataset_entry['name'] + '#'
+                subscribed.update(name for name in item_names if name.startswith(prefix))
+
+        return [(name, site_name) for name in item_names if name in subscribed]
+
+    def add_transfer(self, replica, blocks, group, rid, opid):
+        self._clear_reserved(self.transfers, self._reserved_transfers, replica)
+
+        self.transfers[replica] = (blocks, group, rid, opid)
+        self._transfer_replicas[replica.dataset].add(replica)
+        for block in blocks:
+            self._reserved_transfers[(block, replica.site)] = replica
+
+    def add_deletion(self, replica, blocks, rid, opid):
+        self._clear_reserved(self.deletions, self._reserved_deletions, replica)
+
+        self.deletions[replica] = (blocks, rid, opid)
+        self._deletion_replicas[replica.dataset].add(replica)
+        for block in blocks:
+            self._reserved_deletions[(block, replica.site)] = replica
+
+    def _clear_reserved(self, reservations, reserved, replica):
+        try:
+            blocks = reservations[replica][0]
+        except KeyError:
+            return
+
+        for block in blocks:
+            reserved.pop((block, replica.site), None)
+
+    def transfer_reserved(self, block, site):
+        return (block, site) in self._reserved_transfers
+
+    def deletion_reserved(self, block, site):
+        return (block, site) in self._reserved_deletions
+
+    def discard_transfer(self, rid):
+        self._discarded_transfer_ids.add(rid)
+
+    def discard_deletion(self, rid):
+        self._discarded_deletion_ids.add(rid)
+
+    def remove_block(self, block):
+        """
+        Take a deleted block out of all reservations and discard the reservations made for the block itself.
+        @param block  Block
+        """
+
+        dataset = block.dataset
+
+        for replica in self._transfer_replicas.get(dataset, []):
+            self.transfers[replica][0].discard(block)
+            self._reserved_transfers.pop((block, replica.site), None)
+
+        for replica in self._deletion_replicas.get(dataset, []):
+            self.deletions[replica][0].discard(block)
+            self._reserved_deletions.pop((block, replica.site), None)
+
+        block_full_name = block.full_name()
+
+        self._discarded_transfer_ids.update(self._transfer_ids.get(block_full_name, []))
+        self._discarded_deletion_ids.update(self._deletion_ids.get(block_full_name, []))
+
+    def flush(self):
+        """
+        Delete the discarded reservations from the DB.
+        """
+
+        if self._read_only:
+            return
+
+        self._mysql.delete_many('phedex_transfer_reservations', 'id', list(self._discarded_transfer_ids))
+        self._mysql.delete_many('phedex_deletion_reservations', 'id', list(self._discarded_deletion_ids))
+
+        self._discarded_transfer_ids.clear()
+        self._discarded_deletion_ids.clear()
@@ -0,0 +1,121 @@
+import time
+import logging
+import sqlite3
+import contextlib
+
+LOG = logging.getLogger(__name__)
+
+class UpdaterState(object):
+    """
+    SQLite store of the updater execution state. Tables:
+      replica_delta_updates: one row per delta update (timestamp, number of updated, number of deleted)
+      replica_full_updates: round-robin queue of (site, tier) for full updates
+      updater_runs: per-run metrics (JSON)
+    The database is put in WAL mode so that the delta and full updaters can read while the other is writing,
+    and writers wait for each other (up to the timeout) instead of failing with "database is locked".
+    """
+
+    def __init__(self, path, timeout = 600, read_only = False):
+        self.path = path
+        self.timeout = timeout
+        self._read_only = read_only
+
+        # autocommit mode; write transactions are opened explicitly with BEGIN IMMEDIATE
+        self._db = sqlite3.connect(path, timeout = timeout, isolation_level = None)
+
+        if read_only:
+            # switching the journal mode writes to the database file; the mode is persistent and set by the writers
+            return
+
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        with self.transaction() as cursor:
+            cursor.execute('CREATE INDEX IF NOT EXISTS `replica_delta_updates_timestamp` ON `replica_delta_updates` (`timestamp`)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS `updater_runs` (`timestamp` REAL NOT NULL, `mode` TEXT NOT NULL, `metrics` TEXT NOT NULL)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS `updater_runs_timestamp` ON `updater_runs` (`timestamp`)')
+
+    def close(self):
+        self._db.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Write transaction. The write lock is taken at the start so that concurrent writers queue up
+        on the busy timeout instead of deadlocking on lock upgrade.
+        """
+
+        if self._read_only:
+            raise RuntimeError('Updater state %s is opened read-only.' % self.path)
+
+        cursor = self._db.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        else:
+            cursor.execute('COMMIT')
+
+    def get_last_delta_update(self):
+        """
+        @return  Timestamp of the last delta update or None
+        """
+
+        # MAX over an indexed column is a single index lookup
+        return self._db.execute('SELECT MAX(`timestamp`) FROM `replica_delta_updates`').fetchone()[0]
+
+    def add_delta_update(self, timestamp, num_updated, num_deleted):
+        with self.transaction() as cursor:
+            cursor.execute('INSERT INTO `replica_delta_updates` VALUES (?, ?, ?)', (timestamp, num_updated, num_deleted))
+
+    def get_full_update_queue(self):
+        """
+        @return  [(site, tier)] in round-robin order
+        """
+
+        # sqlite3 gives us unicode
+        return [(str(site), str(tier)) for site, tier in self._db.execute('SELECT `site`, `tier` FROM `replica_full_updates` ORDER BY `id` ASC')]
+
+    def remove_full_updates(self, combos):
+        """
+        @param combos  [(site, tier)]
+        """
+
+        with self.transaction() as cursor:
+            cursor.executemany('DELETE FROM `replica_full_updates` WHERE `site` = ? AND `tier` = ?', combos)
+
+    def add_run(self, timestamp, mode, metrics_json):
+        with self.transaction() as cursor:
+            cursor.execute('INSERT INTO `updater_runs` VALUES (?, ?, ?)', (timestamp, mode, metrics_json))
+
+    def compact(self, retention, vacuum_fraction = 0.25):
+        """
+        Remove delta update and run records older than the retention period. The database file is rebuilt only
+        when the free pages make up at least vacuum_fraction of it, since VACUUM rewrites the whole file under
+        an exclusive lock and would hold up the other updaters on every run otherwise.
+        The latest delta update is always kept.
+        @param retention        Retention period in seconds
+        @param vacuum_fraction  Fraction of free pages above which the file is rebuilt
+        """
+
+        cutoff = time.time() - retention
+
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM `replica_delta_updates` WHERE `timestamp` < ? AND `timestamp` < (SELECT MAX(`timestamp`) FROM `replica_delta_updates`)', (cutoff,))
+            num_deltas = cursor.rowcount
+            cursor.execute('DELETE FROM `updater_runs` WHERE `timestamp` < ?', (cutoff,))
+            num_runs = cursor.rowcount
+
+        if num_deltas != 0 or num_runs != 0:
+            LOG.info('Removed %d delta update and %d run records from the updater state.', num_deltas, num_runs)
+
+        num_free = self._db.execute('PRAGMA freelist_count').fetchone()[0]
+        num_pages = self._db.execute('PRAGMA page_count').fetchone()[0]
+
+        if num_free != 0 and num_free >= num_pages * vacuum_fraction:
+            LOG.info('Rebuilding the updater state database (%d of %d pages free).', num_free, num_pages)
+            # VACUUM cannot run inside a transaction; fold the WAL back into the main file afterwards
+            self._db.execute('VACUUM')
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
@@ -0,0 +1,56 @@
+import logging
+import htcondor
+
+from dynamo.dataformat import Configuration
+
+LOG = logging.getLogger(__name__)
+
+class HTCondorJobQuery(object):
+    """
+    Streaming job ad query over the schedds of an HTCondor pool. Ads are yielded as the schedds send them,
+    so that the caller does not need to hold the full result in memory.
+    """
+
+    def __init__(self, config = None, schedds = None):
+        """
+        @param config   Configuration with collector and schedd_constraint
+        @param schedds  [(name, schedd)] to query instead of locating the schedds through the collector. A schedd
+                        is any object with xquery(requirements, projection) returning an iterable of ads.
+        """
+
+        config = Configuration(config)
+
+        self._collector_name = config.get('collector', None)
+        self._schedd_constraint = config.get('schedd_constraint', 'true')
+
+        self._schedds = schedds
+
+    def iter_jobs(self, constraint = 'true', attributes = []):
+        """
+        @param constraint  Job constraint expression
+        @param attributes  List of attributes to project
+        @return  Generator of job ads
+        """
+
+        for name, schedd in self._get_schedds():
+            LOG.debug('Querying schedd %s', name)
+
+            try:
+                for ad in schedd.xquery(requirements = constraint, projection = attributes):
+                    yield ad
+
+            except (IOError, RuntimeError):
+                # the ads already yielded from this schedd are valid; move on to the next schedd
+                LOG.error('Failed to query schedd %s', name)
+
+    def _get_schedds(self):
+        if self._schedds is None:
+            collector = htcondor.Collector(self._collector_name)
+
+            self._schedds = []
+            for ad in collector.query(htcondor.AdTypes.Schedd, self._schedd_constraint):
+                self._schedds.append((ad['Name'], htcondor.Schedd(ad)))
+
+            LOG.info('Found %d schedds matching %s', len(self._schedds), self._schedd_constraint)
+
+        return self._schedds
@@ -1,12 +1,91 @@
+import math
+import heapq
+import collections
 import logging
 import pprint
+import gzip
+import cStringIO
+from xml.sax.saxutils import escape
 
 from dynamo.utils.interface.webservice import RESTService, GET, POST
 from dynamo.utils.interface.dbs import DBS
-from dynamo.dataformat import Configuration
+from dynamo.dataformat import Configuration, Dataset
 
 LOG = logging.getLogger(__name__)
 
+def escape_attr(value):
+    """
+    @param value  String
+    @return  value escaped for a double-quoted xml attribute
+    """
+
+    # names almost never need escaping
+    if '&' not in value and '<' not in value and '>' not in value and '"' not in value:
+        return value
+
+    return escape(value, {'"': '&quot;'})
+
+def pack_items(items, max_size, max_items):
+    """
+    Bin-pack datasets or blocks into request chunks of at most max_size bytes and max_items items.
+    The number of chunks is estimated from the totals, and the items are placed from the largest into the
+    least-filled chunk, so that the chunks end up with similar sizes. A new chunk is opened only when no
+    chunk can take the item. An item larger than max_size forms a chunk on its own.
+    @param items      List of datasets or blocks
+    @param max_size   Maximum chunk size in bytes
+    @param max_items  Maximum number of items in a chunk
+    @return  List of lists of items
+    """
+
+    if len(items) == 0:
+        return []
+
+    total_size = sum(item.size for item in items)
+    num_chunks = max(int(math.ceil(total_size / float(max_size))), int(math.ceil(len(items) / float(max_items))), 1)
+
+    chunks = [[] for _ in xrange(num_chunks)]
+    heap = [(0, 0, index) for index in xrange(num_chunks)] # (chunk size, number of items, chunk index)
+
+    for item in sorted(items, key = lambda i: i.size, reverse = True):
+        while True:
+            if len(heap) == 0:
+                size, num, index = 0, 0, len(chunks)
+                chunks.append([])
+                break
+
+            size, num, index = heapq.heappop(heap)
+            if num < max_items:
+                break
+
+            # chunk is full in number of items; it is not considered any more
+
+        if num != 0 and size + item.size > max_size:
+            # the least-filled chunk cannot take the item -> no chunk can
+            heapq.heappush(heap, (size, num, index))
+            size, num, index = 0, 0, len(chunks)
+            chunks.append([])
+
+        chunks[index].append(item)
+        heapq.heappush(heap, (size + item.size, num + 1, index))
+
+    return [chunk for chunk in chunks if len(chunk) != 0]
+
+def make_catalog(items):
+    """
+    @param items  List of datasets or blocks
+    @return  {dataset: [block]} to be passed to form_catalog_xml. Datasets have empty block lists.
+    """
+
+    catalog = collections.defaultdict(list)
+
+    for item in items:
+        if type(item) is Dataset:
+            catalog[item] = []
+        else:
+            catalog[item.dataset].append(item)
+
+    return catalog
+
 class PhEDEx(RESTService):
     """A RESTService interface speicific to CMS data management service PhEDEx."""
 
@@ -57,30 +136,116 @@ class PhEDEx(RESTService):
         
         return body
 
-    def form_catalog_xml(self, file_catalogs, human_readable = False):
+    def form_catalog_xml(self, file_catalogs, human_readable = False, compress = False):
         """
         Take a catalog dict of form {dataset: [block]} and form an input xml for delete and subscribe calls.
         @param file_catalogs   {dataset: [block]}
         @param human_readable  If True, return indented xml.
+        @param compress        If True, return the gzipped xml.
         @return  An xml document for delete and subscribe calls.
         """
 
-        # we should consider using an actual xml tool
-        xml = '<data version="2.0">{nl}'
-        xml += '{i1}<dbs name="%s">{nl}' % self.dbs_url
+        writer = CatalogXMLWriter(self.dbs_url, human_readable = human_readable)
 
         for dataset, blocks in file_catalogs.iteritems():
-            xml += '{i2}<dataset name="%s" is-open="%s">{nl}' % (dataset.name, ('y' if dataset.is_open else 'n'))
+            writer.add_dataset(dataset, blocks)
 
-            for block in blocks:
-                xml += '{i3}<block name="%s" is-open="%s"/>{nl}' % (block.full_name(), ('y' if block.is_open else 'n'))
+        return writer.getvalue(compress = compress)
 
-            xml += '{i2}</dataset>{nl}'
+    def catalog_writer(self, human_readable = False):
+        """
+        @return  An empty CatalogXMLWriter to which datasets and blocks can be added one by one.
+        """
 
-        xml += '{i1}</dbs>{nl}'
-        xml += '</data>{nl}'
+        return CatalogXMLWriter(self.dbs_url, human_readable = human_readable)
 
+class CatalogXMLWriter(object):
+    """
+    Streaming writer of the catalog xml for delete and subscribe calls. Datasets and blocks can be added in any
+    order; each element is escaped and formatted once when it is added, and the document is assembled with a
+    single join. Blocks are written under the element of their dataset.
+    """
+
+    def __init__(self, dbs_url, human_readable = False):
         if human_readable:
-            return xml.format(nl = '\n', i1 = ' ', i2 = '  ', i3 = '   ')
+            self._nl = '\n'
+            self._indents = (' ', '  ', '   ')
+        else:
+            self._nl = ''
+            self._indents = ('', '', '')
+
+        self._dataset_template = self._indents[1] + '<dataset name="%s" is-open="%s">' + self._nl
+        self._block_template = self._indents[2] + '<block name="%s" is-open="%s"/>' + self._nl
+
+        self._dbs_url = dbs_url
+
+        self._datasets = {} # {dataset: [start tag, block elements..]}
+        self._dataset_order = []
+
+        # number of dataset and block elements
+        self.num_items = 0
+
+    def add(self, item):
+        """
+        Add a dataset (dataset-level request) or a block.
+        @param item  Dataset or Block
+        """
+
+        if type(item) is Dataset:
+            self._dataset_entry(item)
+        else:
+            self._dataset_entry(item.dataset).append(self._block_template % (escape_attr(item.full_name()), ('y' if item.is_open else 'n')))
+
+        self.num_items += 1
+
+    def add_dataset(self, dataset, blocks = []):
+        """
+        Add a dataset with a list of its blocks.
+        @param dataset  Dataset
+        @param blocks   List of blocks
+        """
+
+        elements = self._dataset_entry(dataset)
+        template = self._block_template
+
+        for block in blocks:
+            elements.append(template % (escape_attr(block.full_name()), ('y' if block.is_open else 'n')))
+
+        self.num_items += 1 + len(blocks)
+
+    def getvalue(self, compress = False):
+        """
+        @param compress  If True, return the gzipped document.
+        @return  The xml document.
+        """
+
+        nl = self._nl
+        i1, i2, i3 = self._indents
+
+        parts = ['<data version="2.0">', nl, i1, '<dbs name="%s">' % escape_attr(self._dbs_url), nl]
+
+        end_tag = i2 + '</dataset>' + nl
+        for dataset in self._dataset_order:
+            parts.extend(self._datasets[dataset])
+            parts.append(end_tag)
+
+        parts.extend([i1, '</dbs>', nl, '</data>', nl])
+
+        xml = ''.join(parts)
+
+        if compress:
+            buf = cStringIO.StringIO()
+            with gzip.GzipFile(fileobj = buf, mode = 'wb', compresslevel = 6) as output:
+                output.write(xml)
+
+            return buf.getvalue()
         else:
-            return xml.format(nl = '', i1 = '', i2 = '', i3 = '')
+            return xml
+
+    def _dataset_entry(self, dataset):
+        try:
+            return self._datasets[dataset]
+        except KeyError:
+            elements = self._datasets[dataset] = [self._dataset_template % (escape_attr(dataset.name), ('y' if dataset.is_open else 'n'))]
+            self._dataset_order.append(dataset)
+            return elements
@@ -0,0 +1,10 @@
+CREATE TABLE `dataset_access_summary` (
+  `dataset_id` int(10) unsigned NOT NULL,
+  `date` date NOT NULL,
+  `num_accesses` int(11) NOT NULL DEFAULT '0',
+  `cputime` float NOT NULL DEFAULT '0',
+  PRIMARY KEY (`date`,`dataset_id`),
+  KEY `datasets` (`dataset_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1
+PARTITION BY RANGE (TO_DAYS(`date`))
+(PARTITION `p_future` VALUES LESS THAN MAXVALUE);
@@ -1,5 +1,8 @@
 <?php
   //Returns data for use in the auxilliary site (phedex_url) 
+
+include_once('transferstore.php');
+
 function escapeJavaScriptText($string) 
 { 
   return str_replace("\n", '\n', str_replace('"', '\"', addcslashes(str_replace("\r", '', (string)$string), "\0..\37'\\"))); 
@@ -8,7 +11,8 @@ function escapeJavaScriptText($string)
 $site = "T2_US_MIT";
 
 if  ((isset($_REQUEST['site']))){
-  $site = $_REQUEST['site'];
+  // site is used in file paths
+  $site = basename($_REQUEST['site']);
   //$site = escapeJavaScriptText($site);
 }
 
@@ -142,6 +146,36 @@ function single_rrd_to_array($rrd,$rrdpath){
   return $rrd_array;
 }
 
+// PhEDEx transfers are read from the transfer store instead of rrd files
+function site_store_to_array($storepath, $site, $replicaname){
+
+  $replicatograph = str_replace('/', "+", $replicaname);
+  $replicatograph = ltrim($replicatograph, '+');
+  $item = '/' . str_replace('+', '/', $replicatograph);
+
+  $end = time();
+  $series = transfer_store_item_series($storepath . $site, $item, $end - 3600 * 24 * 6, $end);
+
+  $siteinfo = array('site' => $site, 'data' => array());
+
+  foreach ($series as $request_id => $replicadata){
+    $copied = array();
+    $total = array();
+    $ratio = array();
+
+    for($j = 0; $j < count($replicadata['total']); $j++){
+      $copied[] = $replicadata['copied'][$j] * 1e-12;
+      $total[] = $replicadata['total'][$j] * 1e-12;
+      $ratio[] = $replicadata['copied'][$j] / $replicadata['total'][$j] * 100;
+    }
+
+    $replicainfo = array('replica' => $request_id . '_' . $replicatograph, 'time' => $replicadata['time'], 'copied' => $copied, 'total' => $total, 'ratio' => $ratio);
+    $siteinfo['data'][] = $replicainfo;
+  }
+
+  return $siteinfo;
+}
+
 if ( (isset($_REQUEST['getSiteRRDs']) && $_REQUEST['getSiteRRDs']) ){
 
 
@@ -149,10 +183,17 @@ if ( (isset($_REQUEST['getSiteRRDs']) && $_REQUEST['getSiteRRDs']) ){
   $d = array();
   for($i = 0; $i < count($rrdpaths); $i++){  
 
+    if (strpos($rrdpaths[$i], 'phedex') !== false){
+      if (is_dir($rrdpaths[$i] . $site))
+        $d[] = site_store_to_array($rrdpaths[$i], $site, $_REQUEST['replicaname']);
+
+      continue;
+    }
+
     foreach (glob($rrdpaths[$i] . "*") as $sitename){
 
       $site1 = str_replace($rrdpaths[$i], '', $sitename);
-      if ($site1 !=  $_REQUEST['site'])
+      if ($site1 !=  $site)
         continue;
       $siteinfo = array('site' => $site1, 'data' => array());
  
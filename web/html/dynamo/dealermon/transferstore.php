@@ -0,0 +1,65 @@
+<?php
+
+// Reader of the transfer progress store written by track_phedex (dynamo.dealer.transferstore).
+// Samples are chunked per site and day (UTC):
+//   <site>/<YYYYMMDD>.idx  one line "<request id> <item name>" per key; the line number is the key index
+//   <site>/<YYYYMMDD>.dat  24-byte records: uint32 time, uint32 key index, float64 copied, float64 total (little-endian)
+
+$transfer_store_record_size = 24;
+
+// Returns array(request id => array('time' => array, 'copied' => array, 'total' => array)) with the samples
+// of one item at a site between $start and $end
+function transfer_store_item_series($sitepath, $item, $start, $end){
+
+  global $transfer_store_record_size;
+
+  $series = array();
+
+  for($day = intval($start / 86400) * 86400; $day <= $end; $day += 86400){
+    $chunk = $sitepath . '/' . gmdate('Ymd', $day);
+
+    // read the samples before the keys; keys are appended before the samples that use them
+    $data = @file_get_contents($chunk . '.dat');
+    if ($data === false)
+      continue;
+
+    $lines = @file($chunk . '.idx', FILE_IGNORE_NEW_LINES);
+    if ($lines === false)
+      continue;
+
+    $requests = array(); // key index => request id
+    foreach ($lines as $index => $line){
+      $fields = explode(' ', $line, 2);
+      if (count($fields) == 2 and $fields[1] == $item)
+        $requests[$index] = intval($fields[0]);
+    }
+
+    if (count($requests) == 0)
+      continue;
+
+    $nrecords = intval(strlen($data) / $transfer_store_record_size);
+
+    for($i = 0; $i < $nrecords; $i++){
+      $offset = $i * $transfer_store_record_size;
+
+      $head = unpack('Vtime/Vkey', substr($data, $offset, 8));
+      if (!isset($requests[$head['key']]) or $head['time'] < $start or $head['time'] > $end)
+        continue;
+
+      // doubles are in machine byte order for unpack; the store is written and read on the same (little-endian) host
+      $values = unpack('dcopied/dtotal', substr($data, $offset + 8, 16));
+
+      $request_id = $requests[$head['key']];
+      if (!isset($series[$request_id]))
+        $series[$request_id] = array('time' => array(), 'copied' => array(), 'total' => array());
+
+      $series[$request_id]['time'][] = $head['time'];
+      $series[$request_id]['copied'][] = $values['copied'];
+      $series[$request_id]['total'][] = $values['total'];
+    }
+  }
+
+  return $series;
+}
+
+?>